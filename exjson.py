@@ -1,50 +1,95 @@
+import collections
+import contextlib
 import datetime
 import hashlib
+import io
 import json
 import os
 import re
+import sys
+import threading
+import time
 
-import urllib.request
+from scripting import parse, aparse, evaluate, aevaluate, evaluate_lazily, extensions, scan_expressions, Template, \
+    LazyMapping, LazySequence, ReferenceRecursionError
+from scripting.extensions import ExtensionRegistry
+from scripting.extensions.context import LoadContext
+from scripting.lexer import find_comments, remove_comments
 
-from scripting import parse, extensions
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 _JSON_OPENING_CHARS = [',', '[', '{', ':']
 _JSON_CLOSING_CHARS = [',', '}', ']']
-_COMMENTS_REGEX = re.compile(r'/\*.*?\*/', re.DOTALL)
-_INCLUDE_DIRECTIVE = re.compile(
-    r'\/\*\#INCLUDE(.*?)\*/|\/\*\ \#INCLUDE(.*?)\*/|\/\/\#INCLUDE(.*\ ?)|\/\/\ \#INCLUDE(.*\ ?)',
-    re.IGNORECASE | re.MULTILINE)
+_INCLUDE_DIRECTIVE = re.compile(r'\ ?\#INCLUDE(.*)', re.IGNORECASE | re.DOTALL)
 _PARENT_FILE_KEY = "parent_file"
 _PARENT_FILE_STRING_SRC = "__string__"
+_DOCUMENT_CACHE_FILE_KEY = "document_cache_file"
+_CONTENT_HASHES_KEY = "content_hashes"
+_LOAD_CONTEXT_KEY = "load_context"
+_CONTENT_HASH_ALGORITHM = "sha256"
+_DOCUMENT_CACHE_VERSION = 1
+_DOWNLOADS_DIR_NAME = ".downloads"
+_CHECKSUM_ALGORITHMS = {32: "md5", 64: "sha256", 128: "blake2b"}
+_CHECKSUM_CACHE = collections.OrderedDict()
+_CHECKSUM_CACHE_LOCK = threading.Lock()
+_CHECKSUM_CACHE_MAX_ENTRIES = 4096
+_SourceFeatures = collections.namedtuple("_SourceFeatures", ["comments", "includes", "calls", "references"])
+_READ_BUFFER_SIZE = 1024 * 1024
+_LINES_CHUNK_SIZE = 4 * 1024 * 1024
 
 
 def load(json_file_path, encoding=None, cls=None, object_hook=None, parse_float=None,
          parse_int=None, parse_constant=None, object_pairs_hook=None, error_on_include_file_not_found=False,
-         error_on_invalid_value=False, **kw):
+         error_on_invalid_value=False, include_cache=None, cache_dir=None, prefetch_includes=False, max_workers=None,
+         http_max_age=None, http_fetcher=None, download_dir=None, include_graph=None, native_values=False, lazy=False,
+         extension_registry=None, **kw):
     """Decodes a JSON source file into a dictionary"""
     file_full_path = os.path.abspath(json_file_path)
     file_path = os.path.dirname(file_full_path)
-    with open(file_full_path, encoding=encoding) as f:
-        json_source = f.read()
-    # Inject source file path
     if kw is None:
         kw = {}
+    # Reuse the document resolved by a previous load if none of the files it is made of changed
+    if cache_dir is not None and include_graph is None and not lazy:
+        decoder_customized = _is_decoder_customized(cls, object_hook, parse_float, parse_int, parse_constant,
+                                                    object_pairs_hook, kw)
+        document_cache_file_path = _get_document_cache_file_path(cache_dir, file_full_path, encoding,
+                                                                 error_on_include_file_not_found,
+                                                                 error_on_invalid_value, decoder_customized,
+                                                                 native_values)
+        cached_document = _read_document_cache(document_cache_file_path)
+        if cached_document is not None:
+            scripted_value = _script_cached_document(cached_document, error_on_invalid_value, native_values,
+                                                     extension_registry)
+            return _decode_cached_document(cached_document, scripted_value, native_values, cls=cls,
+                                           object_hook=object_hook, parse_float=parse_float, parse_int=parse_int,
+                                           parse_constant=parse_constant, object_pairs_hook=object_pairs_hook, **kw)
+        kw[_DOCUMENT_CACHE_FILE_KEY] = document_cache_file_path
+    json_source = _read_root_file(file_full_path, encoding, kw)
+    # Inject source file path
     kw[_PARENT_FILE_KEY] = file_full_path
     return loads(json_source, encoding=encoding, cls=cls, object_hook=object_hook, parse_float=parse_float,
                  parse_int=parse_int, parse_constant=parse_constant, object_pairs_hook=object_pairs_hook,
                  error_on_include_file_not_found=error_on_include_file_not_found,
-                 error_on_invalid_value=error_on_invalid_value, includes_path=file_path, **kw)
+                 error_on_invalid_value=error_on_invalid_value, includes_path=file_path,
+                 include_cache=include_cache, prefetch_includes=prefetch_includes, max_workers=max_workers,
+                 http_max_age=http_max_age, http_fetcher=http_fetcher, download_dir=download_dir,
+                 include_graph=include_graph, native_values=native_values, lazy=lazy,
+                 extension_registry=extension_registry, **kw)
 
 
 def loads(json_string, encoding=None, cls=None, object_hook=None, parse_float=None,
           parse_int=None, parse_constant=None, object_pairs_hook=None,
-          error_on_include_file_not_found=False, error_on_invalid_value=False, includes_path=None, **kw):
+          error_on_include_file_not_found=False, error_on_invalid_value=False, includes_path=None,
+          include_cache=None, prefetch_includes=False, max_workers=None, http_max_age=None, http_fetcher=None,
+          download_dir=None, include_graph=None, native_values=False, lazy=False, extension_registry=None, **kw):
     """Decodes a provided JSON source string into a dictionary"""
     _json_includes_cache = {}
     if json_string is None or json_string.strip(' ') == '':
         raise AttributeError('No JSON source was provided for decoding.')
-    if includes_path is None:
-        includes_path = os.path.dirname(os.path.realpath(__file__))
     # Initialize Include Cache
     _json_includes_cache = {}
     # Process Include Directives
@@ -52,15 +97,343 @@ def loads(json_string, encoding=None, cls=None, object_hook=None, parse_float=No
         parent_file_path = kw[_PARENT_FILE_KEY]
     else:
         parent_file_path = _PARENT_FILE_STRING_SRC
-    json_source = _include_files(includes_path, json_string, encoding, _json_includes_cache,
-                                 error_on_include_file_not_found, [parent_file_path])
-    json_source = _remove_comments(json_source)
+    # Document cache file injected by load when a cache_dir is used
+    document_cache_file_path = None
+    dependencies = None
+    content_hashes = None
+    if kw is not None and _DOCUMENT_CACHE_FILE_KEY in kw:
+        document_cache_file_path = kw.pop(_DOCUMENT_CACHE_FILE_KEY)
+        dependencies = {}
+        content_hashes = kw.pop(_CONTENT_HASHES_KEY, {})
+    # Load context injected by iterload, shared by all the values it streams
+    context = kw.pop(_LOAD_CONTEXT_KEY, None) if kw is not None else None
+    if include_graph is not None:
+        include_graph._reset(parent_file_path)
+    # Scan the source once, so the stages it does not need are skipped
+    features = _scan_features(json_string)
+    if len(features.includes) == 0:
+        json_source = remove_comments(json_string, features.comments)
+    else:
+        if includes_path is None:
+            includes_path = os.path.dirname(os.path.realpath(__file__))
+        # Included files downloaded from the same host share their connections for the whole load
+        fetcher = http_fetcher if http_fetcher is not None else HTTPFetcher()
+        try:
+            # Read all the included files concurrently before assembling the document
+            prefetched = None
+            if prefetch_includes:
+                prefetched = _prefetch_include_files(includes_path, json_string, encoding, max_workers,
+                                                     http_max_age, fetcher, download_dir,
+                                                     _get_checksum_algorithms(include_graph, content_hashes))
+            json_source = _include_files(includes_path, json_string, encoding, _json_includes_cache,
+                                         error_on_include_file_not_found, [parent_file_path],
+                                         _get_shared_include_cache(include_cache), dependencies, prefetched,
+                                         http_max_age, fetcher, download_dir, include_graph, content_hashes,
+                                         features)
+        finally:
+            if http_fetcher is None:
+                fetcher.close()
+        # Included files may call extension functions or reference values
+        calls, references = scan_expressions(json_source)
+        features = features._replace(calls=calls, references=references)
     # Drop parent file key before calling native json loads since it is not supported
     if kw is not None and _PARENT_FILE_KEY in kw:
         kw.pop(_PARENT_FILE_KEY, None)
-    json_source = parse(json_source, error_on_invalid_value)
-    return json.loads(json_source, cls=cls, object_hook=object_hook, parse_float=parse_float,
-                      parse_int=parse_int, parse_constant=parse_constant, object_pairs_hook=object_pairs_hook, **kw)
+    if lazy:
+        if _is_decoder_customized(cls, object_hook, parse_float, parse_int, parse_constant, object_pairs_hook, kw):
+            raise AttributeError("Custom decoder options are not supported by lazy documents.")
+        return evaluate_lazily(json_source, error_on_invalid_value, native_values, extension_registry)
+    resolved_source = json_source
+    if not features.calls and not features.references:
+        # Plain JSON
+        result = json.loads(json_source, cls=cls, object_hook=object_hook, parse_float=parse_float,
+                            parse_int=parse_int, parse_constant=parse_constant, object_pairs_hook=object_pairs_hook,
+                            **kw)
+    elif native_values:
+        # Scripting is evaluated on the decoded document
+        document = evaluate(json_source, error_on_invalid_value, True, extension_registry, context)
+        result = _decode_evaluated_document(document, cls=cls, object_hook=object_hook, parse_float=parse_float,
+                                            parse_int=parse_int, parse_constant=parse_constant,
+                                            object_pairs_hook=object_pairs_hook, **kw)
+        json_source = json.dumps(document) if result is not document else None
+    else:
+        json_source = parse(json_source, error_on_invalid_value, extension_registry, context)
+        result = json.loads(json_source, cls=cls, object_hook=object_hook, parse_float=parse_float,
+                            parse_int=parse_int, parse_constant=parse_constant, object_pairs_hook=object_pairs_hook,
+                            **kw)
+    if document_cache_file_path is not None:
+        dependencies[parent_file_path] = None
+        _write_document_cache(document_cache_file_path, dependencies, content_hashes, resolved_source, json_source,
+                              result, _is_decoder_customized(cls, object_hook, parse_float, parse_int, parse_constant,
+                                                             object_pairs_hook, kw))
+    return result
+
+
+async def aload(json_file_path, encoding=None, cls=None, object_hook=None, parse_float=None,
+                parse_int=None, parse_constant=None, object_pairs_hook=None, error_on_include_file_not_found=False,
+                error_on_invalid_value=False, include_cache=None, cache_dir=None, max_concurrency=10, http_max_age=None,
+                http_fetcher=None, download_dir=None, include_graph=None, native_values=False, extension_registry=None,
+                **kw):
+    """Decodes a JSON source file into a dictionary without blocking the running event loop"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    file_full_path = os.path.abspath(json_file_path)
+    file_path = os.path.dirname(file_full_path)
+    if kw is None:
+        kw = {}
+    # Reuse the document resolved by a previous load if none of the files it is made of changed
+    if cache_dir is not None and include_graph is None:
+        decoder_customized = _is_decoder_customized(cls, object_hook, parse_float, parse_int, parse_constant,
+                                                    object_pairs_hook, kw)
+        document_cache_file_path = _get_document_cache_file_path(cache_dir, file_full_path, encoding,
+                                                                 error_on_include_file_not_found,
+                                                                 error_on_invalid_value, decoder_customized,
+                                                                 native_values)
+        cached_document = await loop.run_in_executor(None, _read_document_cache, document_cache_file_path)
+        if cached_document is not None:
+            scripted_value = await _ascript_cached_document(cached_document, error_on_invalid_value, native_values,
+                                                            extension_registry)
+            return _decode_cached_document(cached_document, scripted_value, native_values, cls=cls,
+                                           object_hook=object_hook, parse_float=parse_float, parse_int=parse_int,
+                                           parse_constant=parse_constant, object_pairs_hook=object_pairs_hook, **kw)
+        kw[_DOCUMENT_CACHE_FILE_KEY] = document_cache_file_path
+    json_source = await loop.run_in_executor(None, _read_root_file, file_full_path, encoding, kw)
+    # Inject source file path
+    kw[_PARENT_FILE_KEY] = file_full_path
+    return await aloads(json_source, encoding=encoding, cls=cls, object_hook=object_hook, parse_float=parse_float,
+                        parse_int=parse_int, parse_constant=parse_constant, object_pairs_hook=object_pairs_hook,
+                        error_on_include_file_not_found=error_on_include_file_not_found,
+                        error_on_invalid_value=error_on_invalid_value, includes_path=file_path,
+                        include_cache=include_cache, max_concurrency=max_concurrency, http_max_age=http_max_age,
+                        http_fetcher=http_fetcher, download_dir=download_dir, include_graph=include_graph,
+                        native_values=native_values, extension_registry=extension_registry, **kw)
+
+
+async def aloads(json_string, encoding=None, cls=None, object_hook=None, parse_float=None,
+                 parse_int=None, parse_constant=None, object_pairs_hook=None,
+                 error_on_include_file_not_found=False, error_on_invalid_value=False, includes_path=None,
+                 include_cache=None, max_concurrency=10, http_max_age=None, http_fetcher=None, download_dir=None,
+                 include_graph=None, native_values=False, extension_registry=None, **kw):
+    """Decodes a provided JSON source string into a dictionary without blocking the running event loop.
+
+    Included files are read and downloaded concurrently, up to max_concurrency at a time, and coroutine extension
+    functions are awaited together.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    if json_string is None or json_string.strip(' ') == '':
+        raise AttributeError('No JSON source was provided for decoding.')
+    if kw is not None and _PARENT_FILE_KEY in kw:
+        parent_file_path = kw.pop(_PARENT_FILE_KEY)
+    else:
+        parent_file_path = _PARENT_FILE_STRING_SRC
+    # Document cache file injected by aload when a cache_dir is used
+    document_cache_file_path = None
+    dependencies = None
+    content_hashes = None
+    if kw is not None and _DOCUMENT_CACHE_FILE_KEY in kw:
+        document_cache_file_path = kw.pop(_DOCUMENT_CACHE_FILE_KEY)
+        dependencies = {}
+        content_hashes = kw.pop(_CONTENT_HASHES_KEY, {})
+    if include_graph is not None:
+        include_graph._reset(parent_file_path)
+    # Scan the source once, so the stages it does not need are skipped
+    features = _scan_features(json_string)
+    if len(features.includes) == 0:
+        json_source = remove_comments(json_string, features.comments)
+    else:
+        if includes_path is None:
+            includes_path = os.path.dirname(os.path.realpath(__file__))
+        # All the files are fetched up front, so assembling the document does not block on I/O
+        fetcher = http_fetcher if http_fetcher is not None else HTTPFetcher()
+        try:
+            prefetched = await _aprefetch_include_files(includes_path, json_string, encoding, max_concurrency,
+                                                        http_max_age, fetcher, download_dir,
+                                                        _get_checksum_algorithms(include_graph, content_hashes))
+            json_source = _include_files(includes_path, json_string, encoding, {}, error_on_include_file_not_found,
+                                         [parent_file_path], _get_shared_include_cache(include_cache), dependencies,
+                                         prefetched, http_max_age, fetcher, download_dir, include_graph,
+                                         content_hashes, features)
+        finally:
+            if http_fetcher is None:
+                fetcher.close()
+        # Included files may call extension functions or reference values
+        calls, references = scan_expressions(json_source)
+        features = features._replace(calls=calls, references=references)
+    resolved_source = json_source
+    if not features.calls and not features.references:
+        # Plain JSON
+        result = json.loads(json_source, cls=cls, object_hook=object_hook, parse_float=parse_float,
+                            parse_int=parse_int, parse_constant=parse_constant, object_pairs_hook=object_pairs_hook,
+                            **kw)
+    elif native_values:
+        document = await aevaluate(json_source, error_on_invalid_value, True, extension_registry)
+        result = _decode_evaluated_document(document, cls=cls, object_hook=object_hook, parse_float=parse_float,
+                                            parse_int=parse_int, parse_constant=parse_constant,
+                                            object_pairs_hook=object_pairs_hook, **kw)
+        json_source = json.dumps(document) if result is not document else None
+    else:
+        json_source = await aparse(json_source, error_on_invalid_value, extension_registry)
+        result = json.loads(json_source, cls=cls, object_hook=object_hook, parse_float=parse_float,
+                            parse_int=parse_int, parse_constant=parse_constant, object_pairs_hook=object_pairs_hook,
+                            **kw)
+    if document_cache_file_path is not None:
+        dependencies[parent_file_path] = None
+        await loop.run_in_executor(None, _write_document_cache, document_cache_file_path, dependencies,
+                                   content_hashes, resolved_source, json_source, result,
+                                   _is_decoder_customized(cls, object_hook, parse_float, parse_int, parse_constant,
+                                                          object_pairs_hook, kw))
+    return result
+
+
+def compile(json_source, encoding=None, error_on_include_file_not_found=False, error_on_invalid_value=False,
+            includes_path=None, include_cache=None, http_max_age=None, http_fetcher=None, download_dir=None,
+            native_values=False, extension_registry=None):
+    """Compiles a JSON source file or string into a Template whose render() evaluates only its dynamic values"""
+    if json_source is None or json_source.strip(' ') == '':
+        raise AttributeError('No JSON source was provided for decoding.')
+    parent_file_path = _PARENT_FILE_STRING_SRC
+    if "\n" not in json_source and os.path.isfile(json_source):
+        parent_file_path = os.path.abspath(json_source)
+        if includes_path is None:
+            includes_path = os.path.dirname(parent_file_path)
+        json_source = _read_file(parent_file_path, encoding)
+    if includes_path is None:
+        includes_path = os.path.dirname(os.path.realpath(__file__))
+    # Includes, comments and references are resolved once
+    fetcher = http_fetcher if http_fetcher is not None else HTTPFetcher()
+    try:
+        json_source = _include_files(includes_path, json_source, encoding, {}, error_on_include_file_not_found,
+                                     [parent_file_path], _get_shared_include_cache(include_cache), None, None,
+                                     http_max_age, fetcher, download_dir)
+    finally:
+        if http_fetcher is None:
+            fetcher.close()
+    return Template(json_source, error_on_invalid_value, native_values, extension_registry)
+
+
+def iterload(json_file_path, prefix="item", encoding=None, cls=None, object_hook=None, parse_float=None,
+             parse_int=None, parse_constant=None, object_pairs_hook=None, error_on_include_file_not_found=False,
+             error_on_invalid_value=False, include_cache=None, http_max_age=None, http_fetcher=None, download_dir=None,
+             native_values=False, extension_registry=None, chunk_size=_READ_BUFFER_SIZE, **kw):
+    """Decodes the values found at prefix in a JSON source file one at a time, reading the file incrementally.
+
+    The prefix is the path to the values separated by dots, where array elements are named item, such as
+    Stages.item. Comments are removed and include directives expanded as the file is read, and every value is
+    decoded as soon as it is complete, so memory use is bounded by the largest value instead of the file size. The
+    values share the extension function state of a load of the whole file, such as sequences and the $.now date and
+    time, while their references are resolved within each value.
+    """
+    file_full_path = os.path.abspath(json_file_path)
+    includes_path = os.path.dirname(file_full_path)
+    includes_cache = {}
+    shared_cache = _get_shared_include_cache(include_cache)
+    fetcher = http_fetcher if http_fetcher is not None else HTTPFetcher()
+
+    def expand_include_directive(directive):
+        try:
+            return _expand_include_directive(directive, includes_path, encoding, includes_cache,
+                                             error_on_include_file_not_found, [file_full_path], shared_cache,
+                                             None, None, http_max_age, fetcher, download_dir)
+        except IncludeError:
+            raise
+        except IncludeRecursionError:
+            raise
+        except Exception as ex:
+            raise IncludeError(exception=ex)
+
+    def read_value_sources(f):
+        source_stream = _SourceStream(expand_include_directive)
+        values = _ValueSplitter(prefix)
+        chunk = f.read(chunk_size)
+        while chunk != "":
+            for part in source_stream.feed(chunk):
+                yield from values.feed(part)
+            chunk = f.read(chunk_size)
+        for part in source_stream.close():
+            yield from values.feed(part)
+        yield from values.close()
+
+    # The load context is passed to every value, as the generator may be resumed from other contexts
+    context = LoadContext(streamed=True)
+    kw[_LOAD_CONTEXT_KEY] = context
+    try:
+        with open(file_full_path, encoding=encoding) as f:
+            for value_source in read_value_sources(f):
+                yield loads(value_source, cls=cls, object_hook=object_hook, parse_float=parse_float,
+                            parse_int=parse_int, parse_constant=parse_constant, object_pairs_hook=object_pairs_hook,
+                            error_on_invalid_value=error_on_invalid_value, native_values=native_values,
+                            extension_registry=extension_registry, **kw)
+    finally:
+        context.close()
+        if http_fetcher is None:
+            fetcher.close()
+
+
+def load_lines(json_file_path, workers=None, ordered=True, encoding=None, cls=None, object_hook=None,
+               parse_float=None, parse_int=None, parse_constant=None, object_pairs_hook=None,
+               error_on_include_file_not_found=False, error_on_invalid_value=False, http_max_age=None,
+               download_dir=None, native_values=False, chunk_size=_LINES_CHUNK_SIZE, **kw):
+    """Decodes a JSON Lines source file, a JSON document per line, into an iterator over its records.
+
+    Comments are removed and lines holding only include directives are replaced by the records of the included JSON
+    Lines files. The file is split into byte ranges of about chunk_size bytes, cut at line ends, decoded by up to
+    workers processes, or by the calling one when workers is 1. Records are returned in file order, or chunk by chunk as
+    soon as they are decoded when not ordered.
+    """
+    import concurrent.futures
+    file_full_path = os.path.abspath(json_file_path)
+    options = dict(encoding=encoding, cls=cls, object_hook=object_hook, parse_float=parse_float, parse_int=parse_int,
+                   parse_constant=parse_constant, object_pairs_hook=object_pairs_hook,
+                   error_on_include_file_not_found=error_on_include_file_not_found,
+                   error_on_invalid_value=error_on_invalid_value, http_max_age=http_max_age,
+                   download_dir=download_dir, native_values=native_values, **kw)
+    file_size = os.path.getsize(file_full_path)
+    byte_ranges = [(start, min(start + chunk_size, file_size)) for start in range(0, file_size, chunk_size)]
+    if workers is not None and workers <= 1:
+        for start, end in byte_ranges:
+            yield from _load_lines_range(file_full_path, start, end, options)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_load_lines_range, file_full_path, start, end, options)
+                   for start, end in byte_ranges]
+        try:
+            for future in futures if ordered else concurrent.futures.as_completed(futures):
+                yield from future.result()
+        finally:
+            # Stop decoding the chunks left when the iteration is not completed
+            for future in futures:
+                future.cancel()
+
+
+def load_many(json_file_paths, workers=None, use_processes=False, include_cache=None, **kw):
+    """Decodes many JSON source files concurrently. Returns their dictionaries in the same order, with the error
+    raised by every file that failed to load in place of its dictionary.
+
+    Files are loaded by up to workers threads sharing an include cache, a new one unless provided, so fragments included
+    by many of them are read and expanded once. With use_processes, they are loaded by worker processes using their
+    process wide include cache. Other arguments are passed to load.
+    """
+    import concurrent.futures
+    json_file_paths = list(json_file_paths)
+    if use_processes:
+        if isinstance(include_cache, IncludeCache):
+            raise AttributeError("IncludeCache instances cannot be shared with worker processes.")
+        include_cache = include_cache is not False
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        if include_cache is None:
+            include_cache = IncludeCache()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    results = []
+    with executor:
+        futures = [executor.submit(_load_file, json_file_path, include_cache, kw) for json_file_path in json_file_paths]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as ex:
+                results.append(ex)
+    return results
 
 
 def dumps(obj, skipkeys=False, ensure_ascii=True, check_circular=True,
@@ -72,103 +445,99 @@ def dumps(obj, skipkeys=False, ensure_ascii=True, check_circular=True,
                       default=default, sort_keys=sort_keys, **kw)
 
 
-def register_custom_scripting_extension(name, fn):
+def register_custom_scripting_extension(name, fn, batch=None):
     """Registers a custom scripting extension function"""
-    return extensions.register_extension_function(name, fn)
+    return extensions.register_extension_function(name, fn, batch)
+
+
+def get_extension_registry():
+    """Gets the process wide extension registry used when loading without an extension_registry"""
+    return extensions.get_default_registry()
+
+
+def get_include_cache():
+    """Gets the process wide include fragment cache used when loading with include_cache=True"""
+    return _INCLUDE_CACHE
+
+
+def _get_shared_include_cache(include_cache):
+    """Resolves the include_cache argument into an IncludeCache instance or None when disabled"""
+    if include_cache is None or include_cache is False:
+        return None
+    if include_cache is True:
+        return _INCLUDE_CACHE
+    if isinstance(include_cache, IncludeCache):
+        return include_cache
+    raise AttributeError("include_cache must be a boolean or an IncludeCache instance.")
 
 
 def _include_files(include_files_path, string, encoding=None, cache=None, error_on_file_not_found=False,
-                   parent_file_paths=None):
-    """Include all files included in current json string"""
+                   parent_file_paths=None, shared_cache=None, dependencies=None, prefetched=None, http_max_age=None,
+                   http_fetcher=None, download_dir=None, graph=None, content_hashes=None, features=None):
+    """Include all files included in current json string. The features already scanned from the string, its comments
+    and include directives, are reused when provided."""
     try:
-        includes = re.finditer(_INCLUDE_DIRECTIVE, string)
         # Files Cache
         if cache is None:
             cache = {}
         if parent_file_paths is None:
             parent_file_paths = []
-        for match_num, match in enumerate(includes):
-            if len(match.groups()) > 0:
-                for value in match.groups():
-                    if value is None:
-                        continue
-                    http_download = False
-                    include_call_string = str(match.group())
-                    property_name = ""
-                    file_name = _remove_enclosing_chars(value)
-                    default_value = None
-                    file_expected_checksum = None
-                    if ":" in file_name:
-                        values = file_name.split(":", 1)
-                        property_name = values[0]
-                        file_name = values[1]
-                        if '|' in file_name:
-                            file_properties = file_name.split('|')
-                            file_properties_count = len(file_properties)
-                            file_name = file_properties[0].strip(' ')
-                            if file_properties_count > 1:
-                                default_value = file_properties[1].strip(' ')
-                            elif file_properties >= 2:
-                                file_expected_checksum = file_properties[2].strip(' ')
-                    if 'http://' in file_name or 'https://' in file_name:
-                        http_download = True
-                        include_file_path = _download_file(file_name, include_files_path)
-                        # TODO: Create file with download information and checksum
-                    else:
-                        include_file_path = os.path.normpath(os.path.join(include_files_path, file_name))
-                    if os.path.abspath(include_file_path):
-                        # Cache File if not already cached.
-                        if include_file_path not in cache:
-                            try:
-                                if include_file_path in cache.keys() or include_file_path in parent_file_paths:
-                                    raise IncludeRecursionError(include_file_path)
-                                parent_file_list = parent_file_paths + [include_file_path]
-                                with open(include_file_path, "r", encoding=encoding) as f:
-                                    cache[include_file_path] = {
-                                        "src": ""
-                                    }
-                                    if file_expected_checksum is not None:
-                                        if not _check_file_checksum(include_file_path, file_expected_checksum):
-                                            raise IOError("Include File has checksum does not match expected.")
-                                    included_file_source = _include_files(include_files_path, f.read(), encoding, cache,
-                                                                          error_on_file_not_found,
-                                                                          parent_file_list)
-                                cache[include_file_path]["src"] = included_file_source
-                            except IOError as ex:
-                                if error_on_file_not_found:
-                                    raise IOError("Included file '{0}' was not found.".format(include_file_path))
-                                else:
-                                    if default_value is not None:
-                                        cache[include_file_path] = {"src": default_value}
-            # Extract content from include file removing comments, end of lines and tabs
-            if include_file_path in cache:
-                included_source = cache[include_file_path]["src"]
-                included_source = _remove_comments(included_source).strip(' ').strip('\r\n').strip('\n').strip(
-                    '\t')
-            else:
-                included_source = ""
-            # Add Property Name if specified
-            if property_name is not None and property_name.strip(' ') != '':
-                included_source = "\"{0}\": {1}".format(property_name, included_source)
-            # Add Comma if needed and determine if property is required
-            included_source_first_char = _get_first_char(included_source)
-            included_source_last_char = _get_last_char(included_source)
-            included_source_surrounding_src = string.split(include_call_string)
-            included_source_surrounding_src_count = len(included_source_surrounding_src) - 1
-            for i in range(0, included_source_surrounding_src_count):
-                included_call_pre_last_char = _get_last_char(
-                    _remove_comments(included_source_surrounding_src[i]))
-                # Add comma at the beginning of the included code if required
-                if included_call_pre_last_char not in _JSON_OPENING_CHARS and included_source_first_char != ',':
-                    included_source = "," + included_source
-                # Add Trailing comma if code following the included statement does not have one.
-                if included_source.strip(' ') != '' and i < included_source_surrounding_src_count:
-                    if included_source_last_char != ',' and _get_first_char(
-                            _remove_comments(
-                                included_source_surrounding_src[i + 1])) not in _JSON_CLOSING_CHARS:
-                        included_source = included_source + ','
-            string = string.replace(include_call_string, included_source)
-        return string
+        # Lex the source once: include directives and the literal segments surrounding them, without comments.
+        if features is not None:
+            comments, directives = features.comments, features.includes
+        else:
+            comments = find_comments(string)
+            directives = _find_include_directives(string, comments)
+        if len(directives) == 0:
+            return remove_comments(string, comments)
+        segments = []
+        segment_parts = []
+        segment_start = 0
+        directive_index = 0
+        for start, end in comments:
+            segment_parts.append(string[segment_start:start])
+            segment_start = end
+            if directive_index < len(directives) and directives[directive_index][0] == start:
+                segments.append("".join(segment_parts))
+                segment_parts = []
+                directive_index += 1
+        segment_parts.append(string[segment_start:])
+        segments.append("".join(segment_parts))
+        # First character following each directive. Directives are comments, so a directive followed only by other
+        # directives, comments or blanks takes the first character found after them.
+        following_chars = [''] * len(directives)
+        following_char = ''
+        for i in range(len(directives) - 1, -1, -1):
+            segment_first_char = _get_first_char(segments[i + 1])
+            if segment_first_char != '':
+                following_char = segment_first_char
+            following_chars[i] = following_char
+        # Build the output in a single forward pass
+        output = []
+        preceding_char = ''
+        for i, (start, end, directive) in enumerate(directives):
+            output.append(segments[i])
+            segment_last_char = _get_last_char(segments[i])
+            if segment_last_char != '':
+                preceding_char = segment_last_char
+            included_source, included_source_first_char, included_source_last_char = _expand_include_directive(
+                directive, include_files_path, encoding, cache, error_on_file_not_found, parent_file_paths,
+                shared_cache, dependencies, prefetched, http_max_age, http_fetcher, download_dir, graph,
+                content_hashes)
+            # Add comma at the beginning of the included code if required
+            if preceding_char not in _JSON_OPENING_CHARS and included_source_first_char != ',':
+                included_source = "," + included_source
+                preceding_char = ','
+            if included_source_last_char != '':
+                preceding_char = included_source_last_char
+            # Add Trailing comma if code following the included statement does not have one.
+            if included_source.strip(' ') != '':
+                if included_source_last_char != ',' and following_chars[i] not in _JSON_CLOSING_CHARS:
+                    included_source = included_source + ','
+                    preceding_char = ','
+            output.append(included_source)
+        output.append(segments[-1])
+        return "".join(output)
     except IncludeError:
         raise
     except IncludeRecursionError:
@@ -177,45 +546,733 @@ def _include_files(include_files_path, string, encoding=None, cache=None, error_
         raise IncludeError(exception=ex)
 
 
-def _download_file(url, local_path):
-    file_name = url[url.rfind("/") + 1:]
-    if not file_name.endswith('.json'):
-        file_name = f"{file_name}.json"
-    info_file_name = file_name.replace('.json', '.http.json')
-    local_file_path = os.path.join(local_path, file_name)
-    info_file_path = os.path.join(local_path, info_file_name)
+def _expand_include_directive(directive, include_files_path, encoding=None, cache=None, error_on_file_not_found=False,
+                              parent_file_paths=None, shared_cache=None, dependencies=None, prefetched=None,
+                              http_max_age=None, http_fetcher=None, download_dir=None, graph=None, content_hashes=None):
+    """Expands an include directive. Returns the trimmed included source along with its first and last characters.
+
+    The content hashes of the files read are added to the provided content_hashes.
+    """
+    property_name, file_name, default_value, file_expected_checksum = _parse_include_directive(directive)
+    include_file_path = _get_include_file_path(file_name, include_files_path, prefetched, http_max_age,
+                                               http_fetcher, download_dir, file_expected_checksum)
+    if graph is not None:
+        graph._add_edge(parent_file_paths[-1], include_file_path, file_name if _is_url(file_name) else None)
+    claimed_key = None
+    # Reuse the fragment expanded by a previous load if none of the files it depends on changed.
+    if include_file_path not in cache and shared_cache is not None and file_expected_checksum is None:
+        shared_key = (include_file_path, include_files_path, encoding, error_on_file_not_found)
+        # Wait for the fragment when a concurrent load is expanding it, so it is only expanded once
+        if shared_cache._claim(shared_key):
+            claimed_key = shared_key
+        shared_entry = shared_cache.get(shared_key)
+        # Fragments including any of the files being expanded are processed again to raise recursion errors
+        if shared_entry is not None and not any(p in parent_file_paths for p in shared_entry["deps"]):
+            if graph is None:
+                cache[include_file_path] = {"src": shared_entry["src"], "deps": shared_entry["deps"]}
+            elif shared_entry["graph"] is not None:
+                cache[include_file_path] = {"src": shared_entry["src"], "deps": shared_entry["deps"]}
+                graph._update(shared_entry["graph"])
+    try:
+        # Cache File if not already cached.
+        if include_file_path not in cache:
+            try:
+                if include_file_path in parent_file_paths:
+                    raise IncludeRecursionError(include_file_path)
+                parent_file_list = parent_file_paths + [include_file_path]
+                included_file_source, file_signature, file_checksums = _read_include_file(
+                    include_file_path, encoding, file_expected_checksum, prefetched,
+                    _get_checksum_algorithms(graph, content_hashes))
+                if graph is not None:
+                    graph._add_node(include_file_path, file_checksums["md5"], file_signature)
+                if content_hashes is not None:
+                    content_hashes[include_file_path] = file_checksums[_CONTENT_HASH_ALGORITHM]
+                cache[include_file_path] = {
+                    "src": "",
+                    "deps": {}
+                }
+                file_dependencies = {include_file_path: file_signature}
+                included_file_source = _include_files(include_files_path, included_file_source, encoding, cache,
+                                                      error_on_file_not_found, parent_file_list, shared_cache,
+                                                      file_dependencies, prefetched, http_max_age,
+                                                      http_fetcher, download_dir, graph, content_hashes)
+                cache[include_file_path]["src"] = included_file_source
+                cache[include_file_path]["deps"] = file_dependencies
+                if shared_cache is not None:
+                    shared_cache.put((include_file_path, include_files_path, encoding, error_on_file_not_found),
+                                     included_file_source, file_dependencies,
+                                     graph._get_subgraph(include_file_path) if graph is not None else None)
+            except IOError as ex:
+                if error_on_file_not_found:
+                    raise IOError("Included file '{0}' was not found.".format(include_file_path))
+                else:
+                    if default_value is not None:
+                        cache[include_file_path] = {
+                            "src": default_value,
+                            "deps": {include_file_path: _get_file_signature(include_file_path)}
+                        }
+                    if graph is not None:
+                        graph._add_node(include_file_path, None, _get_file_signature(include_file_path))
+    finally:
+        if claimed_key is not None:
+            shared_cache._release(claimed_key)
+    if dependencies is not None:
+        if _is_url(file_name):
+            dependencies[file_name] = None
+        if include_file_path in cache:
+            dependencies.update(cache[include_file_path]["deps"])
+        else:
+            dependencies[include_file_path] = _get_file_signature(include_file_path)
+    # Extract content from include file removing comments, end of lines and tabs
+    included_source, included_source_first_char, included_source_last_char = _get_included_source(
+        cache.get(include_file_path))
+    # Add Property Name if specified
+    if property_name is not None and property_name.strip(' ') != '':
+        included_source = "\"{0}\": {1}".format(property_name, included_source)
+        included_source_first_char = '"'
+        if included_source_last_char == '':
+            included_source_last_char = ':'
+    return included_source, included_source_first_char, included_source_last_char
+
+
+def _load_file(json_file_path, include_cache, kw):
+    """Loads a file of a load_many batch"""
+    return load(json_file_path, include_cache=include_cache, **kw)
+
+
+def _load_lines_range(file_path, start, end, options):
+    """Decodes the records of the lines starting within a byte range of a JSON Lines file"""
+    records = []
+    with open(file_path, "rb") as f:
+        # The line found at the start of the range belongs to the previous one, unless it starts there
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        position = f.tell()
+        while position < end:
+            line = f.readline()
+            if line == b"":
+                break
+            position += len(line)
+            records.extend(_load_line(line.decode(options["encoding"] or "utf-8"), os.path.dirname(file_path),
+                                      [file_path], options))
+    return records
+
+
+def _load_line(line, includes_path, parent_file_paths, options):
+    """Decodes a line of a JSON Lines source. Lines holding only include directives get the included records."""
+    comments = find_comments(line)
+    if remove_comments(line, comments).strip() != "":
+        return [loads(line, includes_path=includes_path, **options)]
+    records = []
+    for start, end, directive in _find_include_directives(line, comments):
+        records.extend(_load_included_lines(directive, includes_path, parent_file_paths, options))
+    return records
+
+
+def _load_included_lines(directive, includes_path, parent_file_paths, options):
+    """Decodes the records of a JSON Lines file included by a directive"""
+    property_name, file_name, default_value, file_expected_checksum = _parse_include_directive(directive)
+    if property_name.strip(' ') != '':
+        raise AttributeError("Include directives of JSON Lines sources cannot set a property name.")
     try:
-        file_size = 0
-        file_checksum = ""
-        with urllib.request.urlopen(url) as r:
-            with open(local_file_path, 'wb') as f:
-                data = r.read()
-                f.write(data)
-                file_size = len(data)
-            with open(info_file_path, 'w') as f:
-                data = {
+        include_file_path = _get_include_file_path(file_name, includes_path, None, options["http_max_age"], None,
+                                                   options["download_dir"], file_expected_checksum)
+        if include_file_path in parent_file_paths:
+            raise IncludeRecursionError(include_file_path)
+        included_source = _read_include_file(include_file_path, options["encoding"], file_expected_checksum)[0]
+    except IOError:
+        if options["error_on_include_file_not_found"]:
+            raise IOError("Included file '{0}' was not found.".format(file_name))
+        if default_value is None or default_value == "":
+            return []
+        return [loads(default_value, includes_path=includes_path, **options)]
+    records = []
+    for line in included_source.splitlines():
+        records.extend(_load_line(line, os.path.dirname(include_file_path), parent_file_paths + [include_file_path],
+                                  options))
+    return records
+
+
+def _scan_features(string):
+    """Finds the extended features a source uses: its comments, include directives, extension function calls and
+    references. Plain JSON sources use none of them and are decoded as they are."""
+    comments = find_comments(string)
+    includes = _find_include_directives(string, comments) if len(comments) > 0 else []
+    calls, references = scan_expressions(string)
+    return _SourceFeatures(comments, includes, calls, references)
+
+
+def _find_include_directives(string, comments=None):
+    """Finds the include directives, comments starting with #INCLUDE. Returns their (start, end, directive) values."""
+    if comments is None:
+        comments = find_comments(string)
+    directives = []
+    for start, end in comments:
+        if string[start + 1] == "*":
+            match = _INCLUDE_DIRECTIVE.match(string, start + 2, end - 2)
+        else:
+            match = _INCLUDE_DIRECTIVE.match(string, start + 2, end)
+        if match is not None:
+            directives.append((start, end, match.group(1)))
+    return directives
+
+
+def _parse_include_directive(value):
+    """Parses an include directive into its property name, file name, default value and expected checksum"""
+    property_name = ""
+    default_value = None
+    file_expected_checksum = None
+    file_properties = _remove_enclosing_chars(value).split('|')
+    file_name = file_properties[0]
+    # The property name is separated by a colon, not to be confused with the one of an url scheme
+    if ":" in file_name and not file_name.strip(' ').startswith(("http://", "https://")):
+        property_name, file_name = file_name.split(":", 1)
+    file_name = file_name.strip(' ')
+    if len(file_properties) > 1:
+        default_value = file_properties[1].strip(' ')
+    if len(file_properties) > 2 and file_properties[2].strip(' ') != '':
+        file_expected_checksum = file_properties[2].strip(' ')
+    return property_name, file_name, default_value, file_expected_checksum
+
+
+def _get_include_file_path(file_name, include_files_path, prefetched=None, http_max_age=None, http_fetcher=None,
+                           download_dir=None, expected_checksum=None):
+    """Gets the local path of an included file downloading it first when it is an http/https url"""
+    if _is_url(file_name):
+        if prefetched is not None and prefetched.get(file_name) is not None:
+            if prefetched[file_name]["path_error"] is not None:
+                raise prefetched[file_name]["path_error"]
+            return prefetched[file_name]["path"]
+        if download_dir is None:
+            download_dir = os.path.join(include_files_path, _DOWNLOADS_DIR_NAME)
+        return _download_file(file_name, download_dir, http_max_age, http_fetcher, expected_checksum)
+    return os.path.normpath(os.path.join(include_files_path, file_name))
+
+
+def _read_include_file(include_file_path, encoding=None, expected_checksum=None, prefetched=None,
+                       checksum_algorithms=()):
+    """Reads an included file verifying its checksum when expected.
+
+    Returns its source, signature and the checksums of its content calculated with the expected checksum algorithm and
+    the provided checksum_algorithms.
+    """
+    checksum_algorithms = set(checksum_algorithms)
+    if expected_checksum is not None:
+        checksum_algorithm, expected_checksum = _parse_checksum(expected_checksum)
+        checksum_algorithms.add(checksum_algorithm)
+    prefetched_file = None
+    if prefetched is not None:
+        prefetched_file = prefetched.get(include_file_path)
+    if prefetched_file is not None and prefetched_file["read_error"] is not None:
+        raise prefetched_file["read_error"]
+    if prefetched_file is not None:
+        source = prefetched_file["src"]
+        signature = prefetched_file["signature"]
+        checksums = dict(prefetched_file["checksums"])
+        for algorithm in checksum_algorithms.difference(checksums):
+            checksums[algorithm] = _get_file_checksum(include_file_path, algorithm)
+    else:
+        source, signature, checksums = _read_file_with_checksums(include_file_path, encoding, checksum_algorithms)
+    if expected_checksum is not None and checksums[checksum_algorithm] != expected_checksum:
+        raise IOError("Include File has checksum does not match expected.")
+    return source, signature, checksums
+
+
+def _prefetch_include_files(include_files_path, string, encoding=None, max_workers=None, http_max_age=None,
+                            http_fetcher=None, download_dir=None, checksum_algorithms=()):
+    """Reads every file of the include graph concurrently, downloading the http/https ones.
+
+    Files are submitted to the pool as soon as the directive including them is found, so nested includes are fetched
+    while their siblings are still being read. Errors are kept and raised when the document is assembled.
+    """
+    import concurrent.futures
+    prefetched = {}
+    pending = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit_included_files(source):
+            for start, end, directive in _find_include_directives(source):
+                property_name, file_name, default_value, file_expected_checksum = _parse_include_directive(directive)
+                if _is_url(file_name):
+                    target = file_name
+                else:
+                    target = os.path.normpath(os.path.join(include_files_path, file_name))
+                if target not in prefetched:
+                    prefetched[target] = None
+                    pending.add(executor.submit(_fetch_include_file, target, file_name, include_files_path,
+                                                encoding, file_expected_checksum, http_max_age, http_fetcher,
+                                                download_dir, checksum_algorithms))
+
+        submit_included_files(string)
+        while len(pending) > 0:
+            done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            pending.difference_update(done)
+            for future in done:
+                target, prefetched_file = future.result()
+                prefetched[target] = prefetched_file
+                if prefetched_file["path"] is not None:
+                    prefetched[prefetched_file["path"]] = prefetched_file
+                if prefetched_file["src"] is not None:
+                    submit_included_files(prefetched_file["src"])
+    return prefetched
+
+
+async def _aprefetch_include_files(include_files_path, string, encoding=None, max_concurrency=None,
+                                   http_max_age=None, http_fetcher=None, download_dir=None, checksum_algorithms=()):
+    """Same as _prefetch_include_files but fetching the files from the event loop default executor"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency is not None else None
+    prefetched = {}
+
+    async def fetch_included_file(target, file_name, expected_checksum):
+        if semaphore is not None:
+            async with semaphore:
+                target, prefetched_file = await loop.run_in_executor(None, _fetch_include_file, target, file_name,
+                                                                     include_files_path, encoding, expected_checksum,
+                                                                     http_max_age, http_fetcher, download_dir,
+                                                                     checksum_algorithms)
+        else:
+            target, prefetched_file = await loop.run_in_executor(None, _fetch_include_file, target, file_name,
+                                                                 include_files_path, encoding, expected_checksum,
+                                                                 http_max_age, http_fetcher, download_dir,
+                                                                 checksum_algorithms)
+        prefetched[target] = prefetched_file
+        if prefetched_file["path"] is not None:
+            prefetched[prefetched_file["path"]] = prefetched_file
+        if prefetched_file["src"] is not None:
+            await asyncio.gather(*fetch_included_files(prefetched_file["src"]))
+
+    def fetch_included_files(source):
+        fetches = []
+        for start, end, directive in _find_include_directives(source):
+            property_name, file_name, default_value, file_expected_checksum = _parse_include_directive(directive)
+            if _is_url(file_name):
+                target = file_name
+            else:
+                target = os.path.normpath(os.path.join(include_files_path, file_name))
+            if target not in prefetched:
+                prefetched[target] = None
+                fetches.append(fetch_included_file(target, file_name, file_expected_checksum))
+        return fetches
+
+    await asyncio.gather(*fetch_included_files(string))
+    return prefetched
+
+
+def _fetch_include_file(target, file_name, include_files_path, encoding=None, expected_checksum=None,
+                        http_max_age=None, http_fetcher=None, download_dir=None, checksum_algorithms=()):
+    """Fetches an included file for the prefetch pool, calculating the provided checksums from the same read"""
+    prefetched_file = {
+        "path": None,
+        "path_error": None,
+        "src": None,
+        "read_error": None,
+        "signature": None,
+        "checksums": {}
+    }
+    try:
+        prefetched_file["path"] = _get_include_file_path(file_name, include_files_path, http_max_age=http_max_age,
+                                                         http_fetcher=http_fetcher, download_dir=download_dir,
+                                                         expected_checksum=expected_checksum)
+    except Exception as ex:
+        prefetched_file["path_error"] = ex
+        return target, prefetched_file
+    try:
+        checksum_algorithms = set(checksum_algorithms)
+        if expected_checksum is not None:
+            checksum_algorithms.add(_parse_checksum(expected_checksum)[0])
+        prefetched_file["src"], prefetched_file["signature"], prefetched_file["checksums"] = \
+            _read_file_with_checksums(prefetched_file["path"], encoding, checksum_algorithms)
+    except Exception as ex:
+        prefetched_file["read_error"] = ex
+    return target, prefetched_file
+
+
+def _get_checksum_algorithms(graph, content_hashes):
+    """Gets the checksums calculated when reading included files: md5 for the include graph and the content hash of
+    the document cache"""
+    checksum_algorithms = ()
+    if graph is not None:
+        checksum_algorithms += ("md5",)
+    if content_hashes is not None:
+        checksum_algorithms += (_CONTENT_HASH_ALGORITHM,)
+    return checksum_algorithms
+
+
+def _is_url(file_name):
+    return 'http://' in file_name or 'https://' in file_name
+
+
+def _get_included_source(cache_entry):
+    """Gets the trimmed included source along with its first and last characters. Computed once per file."""
+    if cache_entry is None:
+        return "", "", ""
+    if "clean" not in cache_entry or cache_entry["clean"][0] is not cache_entry["src"]:
+        included_source = cache_entry["src"].strip(' ').strip('\r\n').strip('\n').strip('\t')
+        cache_entry["clean"] = (cache_entry["src"], included_source, _get_first_char(included_source),
+                                _get_last_char(included_source))
+    return cache_entry["clean"][1:]
+
+
+def _download_file(url, download_path, max_age=None, fetcher=None, expected_checksum=None):
+    """Downloads an included file into the content addressed download store found at download_path.
+
+    Files are stored by checksum as objects/<md5>.json, so urls serving the same content share a single file, and
+    every url is mapped to its object by an urls/<url sha256>.http.json info file. Objects are also indexed by their
+    sha256 and blake2b checksums as index/<algorithm>/<checksum> files holding their md5. The ETag and Last-Modified headers
+    kept in the info file are sent back on the next download, so the object is reused when the server replies 304 Not
+    Modified. Objects validated less than max_age seconds ago, or matching the expected checksum, are reused without
+    sending any request. Requests are sent through the provided HTTPFetcher, or a new one when not provided.
+
+    Downloads of the same url are serialized across threads and processes with a lock file, and files are written to
+    a temporary file renamed into place, so concurrent loads never read a partially written file.
+    """
+    objects_path = os.path.join(download_path, "objects")
+    urls_path = os.path.join(download_path, "urls")
+    index_path = os.path.join(download_path, "index")
+    # A pinned checksum is served from the store without touching the network
+    if expected_checksum is not None:
+        object_file_path = _find_stored_object(objects_path, index_path, *_parse_checksum(expected_checksum))
+        if object_file_path is not None:
+            return object_file_path
+    url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    info_file_path = os.path.join(urls_path, f"{url_hash}.http.json")
+    try:
+        os.makedirs(objects_path, exist_ok=True)
+        os.makedirs(urls_path, exist_ok=True)
+        with _lock_file(os.path.join(urls_path, f"{url_hash}.lock")):
+            info = _read_download_info(info_file_path, url)
+            if info is not None and not os.path.isfile(os.path.join(objects_path, f"{info['checksum']}.json")):
+                info = None
+            if info is not None and max_age is not None and time.time() - info.get("validated_timestamp", 0) < max_age:
+                return os.path.join(objects_path, f"{info['checksum']}.json")
+            request_headers = {}
+            if info is not None:
+                if info.get("etag") is not None:
+                    request_headers["If-None-Match"] = info["etag"]
+                if info.get("last_modified") is not None:
+                    request_headers["If-Modified-Since"] = info["last_modified"]
+            if fetcher is None:
+                with HTTPFetcher() as fetcher:
+                    status, headers, data = fetcher.fetch(url, request_headers)
+            else:
+                status, headers, data = fetcher.fetch(url, request_headers)
+            # Not Modified: the stored object is still valid
+            if status != 304 or info is None:
+                if status != 200:
+                    raise IOError(f"HTTP Error {status}")
+                checksum = hashlib.md5(data).hexdigest()
+                object_file_path = os.path.join(objects_path, f"{checksum}.json")
+                if not os.path.isfile(object_file_path):
+                    _write_file_atomically(object_file_path, data)
+                for algorithm in _CHECKSUM_ALGORITHMS.values():
+                    if algorithm != "md5":
+                        index_file_path = os.path.join(index_path, algorithm, hashlib.new(algorithm, data).hexdigest())
+                        os.makedirs(os.path.dirname(index_file_path), exist_ok=True)
+                        _write_file_atomically(index_file_path, checksum.encode("utf-8"))
+                info = {
                     "date": datetime.datetime.utcnow().isoformat(),
                     "url": url,
-                    "file_name": file_name,
-                    "size": file_size,
-                    "checksum": _get_file_checksum(local_file_path)
+                    "file_name": url[url.rfind("/") + 1:],
+                    "size": len(data),
+                    "checksum": checksum,
+                    "etag": headers.get("ETag"),
+                    "last_modified": headers.get("Last-Modified")
                 }
-                f.write(json.dumps(data))
+            info["validated_timestamp"] = time.time()
+            _write_file_atomically(info_file_path, json.dumps(info).encode("utf-8"))
     except Exception as ex:
         raise IOError(f"Include file could not be downloaded from {url}. Ready: {ex}.")
-    return local_file_path
+    return os.path.join(objects_path, f"{info['checksum']}.json")
+
+
+def _find_stored_object(objects_path, index_path, algorithm, checksum):
+    """Finds the stored object with the provided checksum. None if there is none."""
+    if algorithm not in _CHECKSUM_ALGORITHMS.values() or not checksum.isalnum():
+        return None
+    if algorithm == "md5":
+        object_file_path = os.path.join(objects_path, f"{checksum}.json")
+    else:
+        try:
+            with open(os.path.join(index_path, algorithm, checksum), "r") as f:
+                object_file_path = os.path.join(objects_path, "{0}.json".format(f.read().strip()))
+        except (OSError, ValueError):
+            return None
+    return object_file_path if os.path.isfile(object_file_path) else None
+
+
+def _read_download_info(info_file_path, url):
+    """Reads the .http.json info file of a previous download of the provided url. None if there is none."""
+    try:
+        with open(info_file_path, 'r') as f:
+            info = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(info, dict) or info.get("url") != url or info.get("checksum") is None:
+        return None
+    return info
+
+
+def _write_file_atomically(file_path, data):
+    """Writes a file through a temporary file renamed into place so it is never read partially written"""
+    temp_file_path = "{0}.{1}.{2}.tmp".format(file_path, os.getpid(), threading.get_ident())
+    try:
+        with open(temp_file_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_file_path, file_path)
+    finally:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+
+
+@contextlib.contextmanager
+def _lock_file(lock_file_path):
+    """Holds an exclusive lock on the provided lock file, shared by all the threads and processes of the host"""
+    with open(lock_file_path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _read_file(file_path, encoding=None):
+    with open(file_path, encoding=encoding) as f:
+        return f.read()
+
+
+def _read_root_file(file_path, encoding, kw):
+    """Reads the root file of a load. When the document is cached, the file is hashed from the same read so the
+    cached document is bound to the content it was resolved from."""
+    if _DOCUMENT_CACHE_FILE_KEY not in kw:
+        return _read_file(file_path, encoding)
+    source, signature, checksums = _read_file_with_checksums(file_path, encoding, (_CONTENT_HASH_ALGORITHM,))
+    kw[_CONTENT_HASHES_KEY] = {file_path: checksums[_CONTENT_HASH_ALGORITHM]}
+    return source
 
 
-def _get_file_checksum(file_path):
-    hash_md5 = hashlib.md5()
+def _is_decoder_customized(cls, object_hook, parse_float, parse_int, parse_constant, object_pairs_hook, kw):
+    """Determines if json.loads is customized, in which case the decoded result cannot be cached as is"""
+    return (cls is not None or object_hook is not None or parse_float is not None or parse_int is not None or
+            parse_constant is not None or object_pairs_hook is not None or
+            len([k for k in kw if k not in [_PARENT_FILE_KEY, _DOCUMENT_CACHE_FILE_KEY, _CONTENT_HASHES_KEY]]) > 0)
+
+
+def _get_document_cache_file_path(cache_dir, file_path, *options):
+    """Gets the document cache file for a root file and the load options that affect its result"""
+    key = json.dumps([_DOCUMENT_CACHE_VERSION, file_path] + list(options))
+    return os.path.join(cache_dir, "{0}.json".format(hashlib.sha256(key.encode('utf-8')).hexdigest()))
+
+
+def _read_document_cache(document_cache_file_path):
+    """Reads a cached document. None when it is not cached or any of the files it was resolved from changed."""
+    try:
+        with open(document_cache_file_path, "r", encoding="utf-8") as f:
+            cached_document = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached_document.get("version") != _DOCUMENT_CACHE_VERSION:
+        return None
+    for dependency_path, content_hash in cached_document["deps"].items():
+        if _get_file_content_hash(dependency_path) != content_hash:
+            return None
+    return cached_document
+
+
+def _write_document_cache(document_cache_file_path, dependencies, content_hashes, resolved_source, parsed_source,
+                          result, decoder_customized):
+    """Writes a resolved document along with the content hash of every file it was resolved from, as it was read.
+
+    Documents using extension calls (such as $.now, $.uuid or $.sequence) are stored before scripting is evaluated so
+    their values are calculated again on every load.
+    """
+    # Remote files may change without notice, so documents including them are not cached
+    if any(_is_url(p) for p in dependencies):
+        return
+    if "$." in resolved_source:
+        stage, value = "source", resolved_source
+    elif decoder_customized:
+        stage, value = "parsed", parsed_source
+    else:
+        stage, value = "result", result
+    try:
+        # Fragments reused from the include cache were read by previous loads
+        deps = {p: content_hashes[p] if p in content_hashes else _get_dependency_content_hash(p, dependencies[p])
+                for p in dependencies if p != _PARENT_FILE_STRING_SRC}
+        cached_document = {
+            "version": _DOCUMENT_CACHE_VERSION,
+            "deps": deps,
+            "stage": stage,
+            "value": value
+        }
+        # Write to a temporary file first so concurrent loads never read a partially written document
+        os.makedirs(os.path.dirname(document_cache_file_path), exist_ok=True)
+        temp_file_path = "{0}.{1}.{2}.tmp".format(document_cache_file_path, os.getpid(), threading.get_ident())
+        with open(temp_file_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(cached_document))
+        os.replace(temp_file_path, document_cache_file_path)
+    except (OSError, TypeError, ValueError):
+        pass
+
+
+def _script_cached_document(cached_document, error_on_invalid_value=False, native_values=False, registry=None):
+    """Evaluates the extension function calls of a document cached before scripting. None if it needs no scripting."""
+    if cached_document["stage"] != "source":
+        return None
+    if native_values:
+        return evaluate(cached_document["value"], error_on_invalid_value, True, registry)
+    return parse(cached_document["value"], error_on_invalid_value, registry)
+
+
+async def _ascript_cached_document(cached_document, error_on_invalid_value=False, native_values=False,
+                                   registry=None):
+    """Same as _script_cached_document but awaiting coroutine extension function calls on the running event loop"""
+    if cached_document["stage"] != "source":
+        return None
+    if native_values:
+        return await aevaluate(cached_document["value"], error_on_invalid_value, True, registry)
+    return await aparse(cached_document["value"], error_on_invalid_value, registry)
+
+
+def _decode_cached_document(cached_document, scripted_value=None, native_values=False, **kw):
+    """Decodes a cached document evaluating only the stages that were not cached.
+
+    Documents cached before scripting are decoded from their scripted value: the document evaluated on its decoded
+    tree for native values, or the parsed source otherwise.
+    """
+    stage = cached_document["stage"]
+    value = cached_document["value"]
+    if stage == "source":
+        stage = "evaluated" if native_values else "parsed"
+        value = scripted_value
+    if stage == "result":
+        return value
+    if stage == "evaluated":
+        return _decode_evaluated_document(value, **kw)
+    return json.loads(value, **kw)
+
+
+def _decode_evaluated_document(document, **kw):
+    """Applies the custom decoder options to a document evaluated on its decoded tree"""
+    if all(value is None for value in kw.values()):
+        return document
+    return json.loads(json.dumps(document), **kw)
+
+
+def _get_file_content_hash(file_path):
+    """Gets the SHA256 hash of a file content. None when the file does not exist."""
+    hash_sha256 = hashlib.sha256()
+    try:
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                hash_sha256.update(chunk)
+    except OSError:
+        return None
+    return hash_sha256.hexdigest()
+
+
+def _get_dependency_content_hash(file_path, signature):
+    """Gets the content hash of a file read by a previous load. Raises an IOError if its signature changed since."""
+    if signature is None:
+        if os.path.exists(file_path):
+            raise IOError("File '{0}' changed while loading.".format(file_path))
+        return None
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+        if _get_file_signature(f.fileno()) != signature:
+            raise IOError("File '{0}' changed while loading.".format(file_path))
+        content_hash = _get_cached_checksum(file_path, signature, _CONTENT_HASH_ALGORITHM)
+        if content_hash is None:
+            file_hash = hashlib.new(_CONTENT_HASH_ALGORITHM)
+            for chunk in iter(lambda: f.read(_READ_BUFFER_SIZE), b""):
+                file_hash.update(chunk)
+            content_hash = _cache_checksum(file_path, signature, _CONTENT_HASH_ALGORITHM, file_hash.hexdigest())
+    return content_hash
 
 
-def _check_file_checksum(file_path, checksum):
-    return _get_file_checksum(file_path).lower() == checksum.lower()
+def _get_file_signature(file):
+    """Gets the (mtime, size, inode) signature of a file path or descriptor. None when the file does not exist."""
+    try:
+        stat = os.stat(file)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def _get_file_checksum(file_path, algorithm="md5"):
+    """Gets the checksum of a file content, reusing the one calculated last time if the file did not change"""
+    with open(file_path, "rb") as f:
+        signature = _get_file_signature(f.fileno())
+        checksum = _get_cached_checksum(file_path, signature, algorithm)
+        if checksum is None:
+            file_hash = hashlib.new(algorithm)
+            for chunk in iter(lambda: f.read(_READ_BUFFER_SIZE), b""):
+                file_hash.update(chunk)
+            checksum = _cache_checksum(file_path, signature, algorithm, file_hash.hexdigest())
+    return checksum
+
+
+def _read_file_with_checksums(file_path, encoding=None, checksum_algorithms=()):
+    """Reads and decodes a file calculating the checksums of its content from the same read.
+
+    The file is read into a single buffer sized from its stat. Returns its source, signature and checksums.
+    """
+    with open(file_path, "rb") as f:
+        signature = _get_file_signature(f.fileno())
+        data = f.read()
+    checksums = {}
+    for algorithm in checksum_algorithms:
+        checksum = _get_cached_checksum(file_path, signature, algorithm)
+        if checksum is None:
+            checksum = _cache_checksum(file_path, signature, algorithm, hashlib.new(algorithm, data).hexdigest())
+        checksums[algorithm] = checksum
+    # Decode the same way reading the file in text mode does, including universal newlines
+    source = io.TextIOWrapper(io.BytesIO(data), encoding=encoding).read()
+    return source, signature, checksums
+
+
+def _parse_checksum(checksum):
+    """Parses an expected checksum into its algorithm and lower case hex digest.
+
+    The algorithm is either prefixed (sha256:digest) or guessed from the digest length: md5, sha256 or blake2b.
+    """
+    algorithm = None
+    if ":" in checksum:
+        algorithm, checksum = checksum.split(":", 1)
+        algorithm = algorithm.strip(' ').lower()
+    checksum = checksum.strip(' ').lower()
+    if algorithm is None:
+        algorithm = _CHECKSUM_ALGORITHMS.get(len(checksum))
+    if algorithm not in _CHECKSUM_ALGORITHMS.values():
+        raise IOError(f"Unsupported checksum {checksum}. Supported algorithms are md5, sha256 and blake2b.")
+    return algorithm, checksum
+
+
+def _get_cached_checksum(file_path, signature, algorithm):
+    """Gets the checksum calculated for a file while its (mtime, size, inode) signature did not change"""
+    if signature is None:
+        return None
+    with _CHECKSUM_CACHE_LOCK:
+        return _CHECKSUM_CACHE.get((file_path, signature, algorithm))
+
+
+def _cache_checksum(file_path, signature, algorithm, checksum):
+    """Keeps the checksum of a file for its (mtime, size, inode) signature"""
+    if signature is not None:
+        with _CHECKSUM_CACHE_LOCK:
+            _CHECKSUM_CACHE[(file_path, signature, algorithm)] = checksum
+            _CHECKSUM_CACHE.move_to_end((file_path, signature, algorithm))
+            while len(_CHECKSUM_CACHE) > _CHECKSUM_CACHE_MAX_ENTRIES:
+                _CHECKSUM_CACHE.popitem(last=False)
+    return checksum
 
 
 # def _process_value_calls(json_source, error_on_invalid_value=False):
@@ -233,13 +1290,6 @@ def _check_file_checksum(file_path, checksum):
 #     return json_source
 
 
-def _remove_comments(string):
-    """Removes all comments"""
-    string = re.sub(re.compile("/\*.*?\*/", re.DOTALL), "", string)
-    string = re.sub(re.compile("//.*?\n"), "", string)
-    return string
-
-
 def _remove_enclosing_chars(string):
     return string.replace("<", "").replace(">", "").replace("\"", "").replace("'", "").strip(" ")
 
@@ -252,6 +1302,693 @@ def _get_first_char(string):
     return string.replace(' ', '').replace('\r\n', '').replace('\n', '')[:1]
 
 
+class IncludeCache(object):
+    """Process wide LRU cache of expanded include fragments, bounded by the memory used by the cached sources.
+
+    Entries are keyed by the resolved fragment path and validated against the (mtime, size, inode) signature of the
+    fragment and of every file it includes before being reused.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self._max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+        # Fragments being expanded, mapped to the thread expanding them and the event set once they are cached
+        self._claims = {}
+        # Fragment each thread is waiting for
+        self._waits = {}
+
+    def get(self, key):
+        """Gets a cached fragment if none of the files it depends on changed since it was cached"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                for dependency_path, signature in entry["deps"].items():
+                    if _get_file_signature(dependency_path) != signature:
+                        self._discard(key)
+                        entry = None
+                        break
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry
+
+    def put(self, key, src, dependencies, graph=None):
+        """Caches an expanded fragment evicting the least recently used ones when the size limit is exceeded"""
+        size = sys.getsizeof(src)
+        with self._lock:
+            self._discard(key)
+            if size > self._max_bytes:
+                return
+            self._entries[key] = {"src": src, "deps": dict(dependencies), "graph": graph, "size": size}
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                self._discard(next(iter(self._entries)))
+                self._evictions += 1
+
+    def clear(self):
+        """Removes all cached fragments and resets the statistics"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
+
+    def stats(self):
+        """Gets cache usage statistics"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions
+            }
+
+    def _claim(self, key):
+        """Claims the expansion of a fragment, waiting for the thread expanding it if any. Returns whether it was
+        claimed. Threads waiting for a fragment claimed by themselves, directly or through other waiting threads, as
+        done by recursive includes, do not wait and expand it again."""
+        thread_id = threading.get_ident()
+        with self._lock:
+            while key in self._claims:
+                owner_id, expanded = self._claims[key]
+                while owner_id != thread_id and owner_id in self._waits:
+                    waited_claim = self._claims.get(self._waits[owner_id])
+                    if waited_claim is None:
+                        break
+                    owner_id = waited_claim[0]
+                if owner_id == thread_id:
+                    return False
+                self._waits[thread_id] = key
+                self._lock.release()
+                try:
+                    expanded.wait()
+                finally:
+                    self._lock.acquire()
+                    del self._waits[thread_id]
+            self._claims[key] = (thread_id, threading.Event())
+            return True
+
+    def _release(self, key):
+        """Releases a claimed fragment once it is cached or failed to be expanded"""
+        with self._lock:
+            self._claims.pop(key)[1].set()
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry["size"]
+
+
+class IncludeGraph(object):
+    """Files and urls a document is made of, linked by the include directives found in them.
+
+    Nodes are identified by the absolute path of the file, or by the url of downloaded files, and carry the md5
+    checksum of their content (None when the file was not found). Edges follow the include directives, in order, from
+    the including node to the included one. The root node is the loaded file, or __string__ for loads.
+    """
+
+    def __init__(self):
+        self._reset(None)
+
+    @property
+    def root(self):
+        """Gets the root node"""
+        return self._root
+
+    def nodes(self):
+        """Gets all the nodes"""
+        return list(self._nodes)
+
+    def checksum(self, node):
+        """Gets the md5 checksum of a node content"""
+        return self._nodes[node]["checksum"]
+
+    def path(self, node):
+        """Gets the local file path of a node, the downloaded file for urls"""
+        return self._nodes[node]["path"]
+
+    def includes(self, node):
+        """Gets the nodes included by a node, one for each include directive"""
+        return list(self._edges.get(node, []))
+
+    def included_by(self, node):
+        """Gets the nodes including a node"""
+        return [n for n, included_nodes in self._edges.items() if node in included_nodes]
+
+    def dependents(self, node):
+        """Gets the nodes including a node either directly or through other nodes"""
+        found = []
+        pending = [node]
+        while len(pending) > 0:
+            for parent in self.included_by(pending.pop()):
+                if parent not in found:
+                    found.append(parent)
+                    pending.append(parent)
+        return found
+
+    def changed(self):
+        """Gets the file nodes whose modification time, size or inode changed since they were read"""
+        return [n for n, info in self._nodes.items() if info["path"] is not None and not _is_url(n) and
+                _get_file_signature(info["path"]) != info["signature"]]
+
+    def _reset(self, root):
+        self._root = root
+        self._nodes = collections.OrderedDict()
+        self._edges = {}
+        self._keys = {}
+        if root is not None:
+            path = root if root != _PARENT_FILE_STRING_SRC else None
+            self._nodes[root] = {
+                "path": path,
+                "checksum": _get_file_checksum(path) if path is not None else None,
+                "signature": _get_file_signature(path) if path is not None else None
+            }
+
+    def _add_edge(self, parent_path, path, url=None):
+        if url is not None:
+            self._keys[path] = url
+        node = self._keys.get(path, path)
+        self._edges.setdefault(self._keys.get(parent_path, parent_path), []).append(node)
+        if node not in self._nodes:
+            self._nodes[node] = {"path": path, "checksum": None, "signature": None}
+
+    def _add_node(self, path, checksum, signature):
+        self._nodes[self._keys.get(path, path)] = {"path": path, "checksum": checksum, "signature": signature}
+
+    def _get_subgraph(self, path):
+        """Gets the graph made of a node and all the nodes it includes"""
+        subgraph = IncludeGraph()
+        subgraph._root = self._keys.get(path, path)
+        pending = [subgraph._root]
+        while len(pending) > 0:
+            node = pending.pop()
+            if node in subgraph._nodes:
+                continue
+            subgraph._nodes[node] = dict(self._nodes[node])
+            if node in self._edges:
+                subgraph._edges[node] = list(self._edges[node])
+                pending.extend(self._edges[node])
+        subgraph._keys = {p: n for p, n in self._keys.items() if n in subgraph._nodes}
+        return subgraph
+
+    def _update(self, graph):
+        self._keys.update(graph._keys)
+        for node, info in graph._nodes.items():
+            self._nodes[node] = dict(info)
+        for node, included_nodes in graph._edges.items():
+            self._edges[node] = list(included_nodes)
+
+
+class Reloader(object):
+    """Keeps a document loaded from a file up to date with the files it is made of.
+
+    Changes are detected polling the modification time of every local file of the document include graph. Only the
+    included fragments depending on a changed file are expanded again, the rest are reused from an include cache, and
+    the reloaded document replaces the previous one at once, so readers never get a partially reloaded document.
+    Remote included files are only revalidated when the document is reloaded.
+    """
+
+    def __init__(self, json_file_path, interval=1.0, **kw):
+        self._json_file_path = json_file_path
+        self._interval = interval
+        self._include_cache = _get_shared_include_cache(kw.pop("include_cache", None)) or IncludeCache()
+        self._kw = kw
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._last_error = None
+        self._state = self._load()
+
+    @property
+    def document(self):
+        """Gets the last loaded document"""
+        return self._state[0]
+
+    @property
+    def graph(self):
+        """Gets the include graph of the last loaded document"""
+        return self._state[1]
+
+    @property
+    def last_error(self):
+        """Gets the error raised by the last background reload, if it failed"""
+        return self._last_error
+
+    def poll(self):
+        """Reloads the document if any of its files changed. Returns True when it was reloaded."""
+        with self._lock:
+            if len(self._state[1].changed()) == 0:
+                return False
+            self._state = self._load()
+            return True
+
+    def reload(self):
+        """Reloads the document"""
+        with self._lock:
+            self._state = self._load()
+
+    def start(self):
+        """Polls the document files every interval seconds from a background thread"""
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops polling the document files"""
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self):
+        while not self._stop_event.wait(self._interval):
+            # Keep the last loaded document while the files are being edited
+            try:
+                self.poll()
+                self._last_error = None
+            except Exception as ex:
+                self._last_error = ex
+
+    def _load(self):
+        graph = IncludeGraph()
+        document = load(self._json_file_path, include_cache=self._include_cache, include_graph=graph, **self._kw)
+        return document, graph
+
+
+class HTTPFetcher(object):
+    """Downloads http/https included files keeping persistent connections per host.
+
+    Idle connections are reused by the next request to the same host, so a document including many files from the
+    same origin only pays the TCP/TLS handshake once. Failed requests and 5xx responses are retried up to retries
+    times, waiting backoff * 2 ** attempt seconds between attempts. Instances are thread safe and can be shared
+    across loads through the http_fetcher argument.
+    """
+
+    _RETRY_STATUSES = (500, 502, 503, 504)
+    _REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+    def __init__(self, timeout=30, retries=2, backoff=0.5, max_redirects=5):
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._max_redirects = max_redirects
+        self._idle_connections = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, url, headers=None):
+        """Sends a GET request and gets its (status, headers, body), following redirects"""
+        import urllib.parse
+        for _ in range(self._max_redirects + 1):
+            status, response_headers, body = self._request(url, headers or {})
+            if status not in self._REDIRECT_STATUSES or response_headers.get("Location") is None:
+                return status, response_headers, body
+            url = urllib.parse.urljoin(url, response_headers["Location"])
+        raise IOError(f"Too many redirects fetching {url}.")
+
+    def close(self):
+        """Closes all the idle connections"""
+        with self._lock:
+            connections = [c for host_connections in self._idle_connections.values() for c in host_connections]
+            self._idle_connections.clear()
+        for connection in connections:
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _request(self, url, headers):
+        import http.client
+        import urllib.parse
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise IOError(f"Unsupported url {url}.")
+        host = (parts.scheme, parts.hostname, parts.port)
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        attempt = 0
+        while True:
+            connection, reused = self._acquire(host)
+            try:
+                connection.request("GET", target, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                # The server may have dropped an idle connection, retry right away with a new one
+                if reused:
+                    continue
+                if attempt >= self._retries:
+                    raise
+                time.sleep(self._backoff * 2 ** attempt)
+                attempt += 1
+                continue
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(host, connection)
+            if response.status in self._RETRY_STATUSES and attempt < self._retries:
+                time.sleep(self._backoff * 2 ** attempt)
+                attempt += 1
+                continue
+            return response.status, response.headers, body
+
+    def _acquire(self, host):
+        with self._lock:
+            host_connections = self._idle_connections.get(host)
+            if host_connections:
+                return host_connections.pop(), True
+        import http.client
+        scheme, hostname, port = host
+        if scheme == "https":
+            return http.client.HTTPSConnection(hostname, port, timeout=self._timeout), False
+        return http.client.HTTPConnection(hostname, port, timeout=self._timeout), False
+
+    def _release(self, host, connection):
+        with self._lock:
+            self._idle_connections.setdefault(host, []).append(connection)
+
+
+class _SourceStream(object):
+    """Removes the comments of a source read in chunks and expands its include directives as they are found.
+
+    Include directives are expanded by the provided function, returning the included source along with its first and
+    last characters. Commas are added around included sources as done by _include_files, the one following an
+    included source once the next character of the source is known.
+    """
+
+    _CODE_BREAK = re.compile(r'["/]')
+    _STRING_BREAK = re.compile(r'["\\\n]')
+
+    def __init__(self, expand_include_directive):
+        self._expand_include_directive = expand_include_directive
+        self._state = "code"
+        self._pending = ""
+        self._comment = []
+        self._preceding_char = ''
+        self._comma_pending = False
+
+    def feed(self, chunk):
+        """Gets the parts of the source found in a chunk, without comments and with the included sources"""
+        return self._read(self._pending + chunk, False)
+
+    def close(self):
+        """Gets the parts of the source left once all the chunks were fed"""
+        parts = self._read(self._pending, True)
+        if self._state == "line_comment":
+            self._end_comment(parts)
+        elif self._state == "block_comment":
+            # Unterminated block comments are kept, as done by remove_comments
+            self._emit(parts, "".join(self._comment))
+        return parts
+
+    def _read(self, text, final):
+        self._pending = ""
+        parts = []
+        # Code and strings are emitted at once up to the next comment
+        segment_start = 0
+        position = 0
+        while position < len(text):
+            if self._state == "code":
+                match = self._CODE_BREAK.search(text, position)
+                if match is None:
+                    position = len(text)
+                    break
+                i = match.start()
+                if match.group() == '"':
+                    self._state = "string"
+                    position = i + 1
+                elif i + 1 == len(text) and not final:
+                    # The character following the slash is needed to know if it starts a comment
+                    self._pending = "/"
+                    position = i
+                    break
+                elif text[i + 1] == "/" or text[i + 1] == "*":
+                    self._emit(parts, text[segment_start:i])
+                    self._comment = [text[i:i + 2]]
+                    self._state = "line_comment" if text[i + 1] == "/" else "block_comment"
+                    position = i + 2
+                else:
+                    position = i + 1
+            elif self._state == "string":
+                match = self._STRING_BREAK.search(text, position)
+                if match is None:
+                    position = len(text)
+                    break
+                i = match.start()
+                if match.group() == "\\":
+                    if i + 1 == len(text) and not final:
+                        self._pending = "\\"
+                        position = i
+                        break
+                    position = i + 2
+                else:
+                    # Strings end at their closing quote, or at the end of the line when they are not terminated
+                    self._state = "code"
+                    position = i + 1
+            elif self._state == "line_comment":
+                i = text.find("\n", position)
+                if i == -1:
+                    self._comment.append(text[position:])
+                    return parts
+                self._comment.append(text[position:i])
+                self._end_comment(parts)
+                segment_start = position = i
+            else:
+                i = text.find("*/", position)
+                if i == -1:
+                    if text.endswith("*") and not final:
+                        self._comment.append(text[position:-1])
+                        self._pending = "*"
+                    else:
+                        self._comment.append(text[position:])
+                    return parts
+                self._comment.append(text[position:i + 2])
+                self._end_comment(parts)
+                segment_start = position = i + 2
+        if self._state == "code" or self._state == "string":
+            self._emit(parts, text[segment_start:position])
+        return parts
+
+    def _end_comment(self, parts):
+        comment = "".join(self._comment)
+        self._comment = []
+        self._state = "code"
+        if comment[1] == "*":
+            match = _INCLUDE_DIRECTIVE.match(comment, 2, len(comment) - 2)
+        else:
+            match = _INCLUDE_DIRECTIVE.match(comment, 2)
+        if match is None:
+            return
+        included_source, included_source_first_char, included_source_last_char = self._expand_include_directive(
+            match.group(1))
+        # Included sources following each other are separated by the leading comma of the next one
+        self._comma_pending = False
+        # Add comma at the beginning of the included code if required
+        if self._preceding_char not in _JSON_OPENING_CHARS and included_source_first_char != ',':
+            included_source = "," + included_source
+            self._preceding_char = ','
+        if included_source_last_char != '':
+            self._preceding_char = included_source_last_char
+        parts.append(included_source)
+        # Add Trailing comma once the code following the included statement is found, if it does not have one.
+        if included_source.strip(' ') != '' and included_source_last_char != ',':
+            self._comma_pending = True
+
+    def _emit(self, parts, text):
+        if text == "":
+            return
+        if self._comma_pending:
+            first_char = _get_first_char(text)
+            if first_char == '':
+                parts.append(text)
+                return
+            if first_char not in _JSON_CLOSING_CHARS:
+                parts.append(",")
+                self._preceding_char = ','
+            self._comma_pending = False
+        last_char = _get_last_char(text)
+        if last_char != '':
+            self._preceding_char = last_char
+        parts.append(text)
+
+
+class _ValueSplitter(object):
+    """Splits the sources of the values found at a prefix, such as Stages.item, out of a JSON source read in parts"""
+
+    _CODE_BREAK = re.compile(r'["{}\[\]:,()\']')
+    _STRING_BREAK = re.compile(r'["\\]')
+    _NON_BLANK = re.compile(r'\S')
+    _DECODER = json.JSONDecoder()
+
+    def __init__(self, prefix):
+        self._prefix = prefix.split(".") if prefix != "" else []
+        # Path to the current position, the key of every object and item for every array
+        self._path = []
+        self._containers = []
+        self._expected = "value"
+        self._in_string = False
+        self._escaped = False
+        self._call_quote = None
+        self._call_depth = 0
+        self._key = None
+        self._key_start = 0
+        self._value = None
+        self._value_kind = None
+        self._value_depth = 0
+        self._value_start = 0
+
+    def feed(self, text):
+        """Gets the sources of the values completed by a part of the source"""
+        values = []
+        position = 0
+        if self._escaped:
+            self._escaped = False
+            position = 1
+        self._key_start = 0
+        self._value_start = 0
+        while position < len(text):
+            if self._in_string:
+                match = self._STRING_BREAK.search(text, position)
+                if match is None:
+                    break
+                i = match.start()
+                if match.group() == "\\":
+                    if i + 1 == len(text):
+                        self._escaped = True
+                        break
+                    position = i + 2
+                    continue
+                self._in_string = False
+                position = i + 1
+                if self._key is not None:
+                    self._key.append(text[self._key_start:position])
+                    self._path[-1] = json.loads("".join(self._key))
+                    self._key = None
+                elif self._value_kind == "string" and len(self._containers) == self._value_depth:
+                    self._end_value(values, text, position)
+            elif self._call_quote is not None:
+                i = text.find(self._call_quote, position)
+                if i == -1:
+                    break
+                self._call_quote = None
+                position = i + 1
+            else:
+                if self._expected == "value" and self._value is None:
+                    match = self._NON_BLANK.search(text, position)
+                    if match is None:
+                        break
+                    position = match.start()
+                    self._expected = None
+                    if text[position] != "]" and self._path == self._prefix:
+                        end = self._find_json_value_end(text, position)
+                        if end is not None:
+                            values.append(text[position:end])
+                            position = end
+                            continue
+                        self._start_value(text, position)
+                match = self._CODE_BREAK.search(text, position)
+                if match is None:
+                    break
+                i = match.start()
+                char = match.group()
+                position = i + 1
+                if char == '"':
+                    self._in_string = True
+                    if self._expected == "key":
+                        self._expected = None
+                        self._key = []
+                        self._key_start = i
+                elif self._call_depth > 0:
+                    # Extension function call parameters
+                    if char == "(":
+                        self._call_depth += 1
+                    elif char == ")":
+                        self._call_depth -= 1
+                    elif char == "'":
+                        self._call_quote = char
+                elif char == "(":
+                    self._call_depth += 1
+                elif char == "{" or char == "[":
+                    self._containers.append(char)
+                    self._path.append(None if char == "{" else "item")
+                    self._expected = "key" if char == "{" else "value"
+                elif char == "}" or char == "]":
+                    if self._value_kind == "scalar" and len(self._containers) == self._value_depth:
+                        self._end_value(values, text, i)
+                    self._containers.pop()
+                    self._path.pop()
+                    self._expected = None
+                    if self._value_kind == "container" and len(self._containers) == self._value_depth:
+                        self._end_value(values, text, position)
+                elif char == ",":
+                    if self._value_kind == "scalar" and len(self._containers) == self._value_depth:
+                        self._end_value(values, text, i)
+                    if len(self._containers) > 0:
+                        self._expected = "key" if self._containers[-1] == "{" else "value"
+                elif char == ":":
+                    self._expected = "value"
+        if self._key is not None:
+            self._key.append(text[self._key_start:])
+        if self._value is not None:
+            self._value.append(text[self._value_start:])
+        return values
+
+    def close(self):
+        """Gets the source of the value left once all the parts were fed, a value found at the root"""
+        values = []
+        if self._value_kind == "scalar":
+            self._end_value(values, "", 0)
+        return values
+
+    def _find_json_value_end(self, text, position):
+        """Finds the end of a container value found whole in the text when it is plain JSON, skipping it at once"""
+        if text[position] != "{" and text[position] != "[":
+            return None
+        try:
+            return self._DECODER.raw_decode(text, position)[1]
+        except ValueError:
+            return None
+
+    def _start_value(self, text, position):
+        self._value = []
+        self._value_start = position
+        self._value_depth = len(self._containers)
+        if text[position] == "{" or text[position] == "[":
+            self._value_kind = "container"
+        elif text[position] == '"':
+            self._value_kind = "string"
+        else:
+            self._value_kind = "scalar"
+
+    def _end_value(self, values, text, end):
+        self._value.append(text[self._value_start:end])
+        values.append("".join(self._value).strip())
+        self._value = None
+        self._value_kind = None
+
+
 class IncludeRecursionError(Exception):
     def __init__(self, origin=None):
         super().__init__()
@@ -283,3 +2020,6 @@ class IncludeError(Exception):
 
     def __repr__(self):
         return "Invalid Included directive. {0}".format(self._message)
+
+
+_INCLUDE_CACHE = IncludeCache()
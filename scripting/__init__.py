@@ -1,69 +1,299 @@
+import collections
+import collections.abc
+import copy
+import itertools
+import json
+import re
+import threading
+
 from scripting import extensions
+from scripting.extensions.context import LoadContext, load_context
 
 _REF_PREFIXES = ['$this.', '$parent.', '$root.']
+_REF_TERMINATORS = frozenset('"\n\r\t $}],|')
+# Extension function calls and references found outside of string values are decoded as marked string values
+_BARE_EXPRESSION_MARKER = "\x00"
+# String values holding references are marked with their index while references are parsed on the source
+_REFERENCE_SITE_MARKER = "\x01"
+_KEY_SEPARATOR = re.compile(r'\s*:')
+_STRING_OR_EXPRESSION = re.compile(r'"[^"\\\n]*(?:\\.[^"\\\n]*)*"|\$')
 
 
-def parse(source, raise_error_on_invalid_value=False):
+def parse(source, raise_error_on_invalid_value=False, registry=None, context=None):
     if "$." not in source:
         return _parse_reference_calls(source)
-    calls = {}
-    updated_source = source
-    for line in source.splitlines():
-        c = 0
-        while c < len(line):
-            if line[c] == "$":
-                call_close = c + 1
-                call_params = ""
-                while line[call_close] == ".":
-                    call_close = line.find(")", call_close + 1) + 1
-                if call_close > 0:
-                    func_call = line[c:call_close]
-                    calls[func_call] = extensions.get_function(func_call)
-                    c += call_close
-            c += 1
-    for fn_key in calls.keys():
-        if hasattr(calls[fn_key][0], "_isolated_instance_execution") and calls[fn_key][0]._isolated_instance_execution:
-            i = 0
-            new_updated_source = ""
-            for call_instance in updated_source.split(fn_key):
-                if i == 0:
-                    updated_instance = call_instance
-                else:
-                    updated_instance = str(calls[fn_key][0](*calls[fn_key][1])) + call_instance
-                new_updated_source += updated_instance
-                i += 1
-            updated_source = new_updated_source
-            # Call Close Function for the Extension call
-            if hasattr(calls[fn_key][0], "_close") and calls[fn_key][0]._close is not None:
-                calls[fn_key][0]._close()
-        else:
-            updated_source = updated_source.replace(fn_key, str(calls[fn_key][0](*calls[fn_key][1])))
+    calls, spans = _find_calls(source, raise_error_on_invalid_value, registry=registry)
+    awaited_results = _run_coroutine_calls(calls, spans)
+    updated_source = _apply_calls(source, calls, spans, awaited_results, context)
     # Parse Reference Calls
     updated_source = _parse_reference_calls(updated_source)
     # Result
     return updated_source
 
 
+async def aparse(source, raise_error_on_invalid_value=False, registry=None):
+    """Same as parse but awaits all the coroutine extension function calls concurrently"""
+    if "$." not in source:
+        return _parse_reference_calls(source)
+    calls, spans = _find_calls(source, raise_error_on_invalid_value, registry=registry)
+    awaited_results = None
+    if _has_coroutine_calls(calls):
+        awaited_results = await _await_coroutine_calls(calls, spans)
+    updated_source = _apply_calls(source, calls, spans, awaited_results)
+    return _parse_reference_calls(updated_source)
+
+
+def _find_calls(source, raise_error_on_invalid_value=False, calls=None, unknown_calls=None, registry=None):
+    """Finds all extension function calls in a single pass.
+
+    Returns the distinct calls, mapped to their function and parameters, and the (start, end, call) span of every
+    call instance in the source. The distinct calls found in other sources can be provided to be extended. Functions
+    are looked up in the provided extension registry or in the default one.
+    """
+    if registry is None:
+        registry = extensions.get_default_registry()
+    if calls is None:
+        calls = {}
+    if unknown_calls is None:
+        unknown_calls = set()
+    spans = []
+    c = source.find("$.")
+    while c != -1:
+        call_close = _find_call_close(source, c)
+        if call_close is None:
+            c = source.find("$.", c + 2)
+            continue
+        func_call = source[c:call_close]
+        if func_call not in calls and func_call not in unknown_calls:
+            call = registry.get_call(func_call)
+            if call is not None:
+                calls[func_call] = call
+            elif raise_error_on_invalid_value:
+                raise AttributeError(f"Unknown extension function call {func_call}.")
+            else:
+                unknown_calls.add(func_call)
+        if func_call in calls:
+            spans.append((c, call_close, func_call))
+        c = source.find("$.", call_close)
+    return calls, spans
+
+
+def _find_call_close(source, call_start):
+    """Gets the position following an extension function call, including chained calls. None if there is no call."""
+    i = call_start + 2
+    call_close = None
+    while True:
+        while i < len(source) and (source[i].isalnum() or source[i] == "_" or source[i] == "."):
+            i += 1
+        if i >= len(source) or source[i] != "(":
+            return call_close
+        i = _find_closing_parenthesis(source, i)
+        if i is None:
+            return call_close
+        call_close = i + 1
+        i = call_close
+        if i >= len(source) or source[i] != ".":
+            return call_close
+
+
+def _find_closing_parenthesis(source, opening):
+    """Finds the parenthesis closing the provided one, skipping nested ones and quoted strings on the same line"""
+    depth = 0
+    quote = None
+    i = opening
+    while i < len(source):
+        char = source[i]
+        if char == "\n":
+            return None
+        if quote is not None:
+            if char == "\\":
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char == "'" or char == '"':
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return None
+
+
+def _run_coroutine_calls(calls, spans):
+    """Awaits all coroutine extension function calls together on a private event loop. None if there are none."""
+    if not _has_coroutine_calls(calls):
+        return None
+    import asyncio
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(_await_coroutine_calls(calls, spans))
+        finally:
+            loop.close()
+    raise RuntimeError("Coroutine extension functions cannot be evaluated synchronously from a running event loop. "
+                       "Use aparse() (exjson.aload/aloads) instead.")
+
+
+def _has_coroutine_calls(calls):
+    if len(calls) == 0:
+        return False
+    import inspect
+    return any(inspect.iscoroutinefunction(calls[fn_key][0].fn) for fn_key in calls.keys())
+
+
+async def _await_coroutine_calls(calls, spans):
+    """Awaits all coroutine extension function calls together. Isolated functions are awaited once per instance."""
+    import asyncio
+    import inspect
+    instance_counts = collections.Counter(span[-1] for span in spans)
+    keys = []
+    coroutines = []
+    for fn_key in calls.keys():
+        extension_function, fn_parameters = calls[fn_key]
+        if inspect.iscoroutinefunction(extension_function.fn):
+            instances = instance_counts[fn_key] if extension_function.isolated else 1
+            for i in range(0, instances):
+                keys.append(fn_key)
+                coroutines.append(extension_function.fn(*fn_parameters))
+    results = {}
+    for fn_key, result in zip(keys, await asyncio.gather(*coroutines)):
+        results.setdefault(fn_key, []).append(result)
+    return results
+
+
+def _apply_calls(source, calls, spans, awaited_results=None, context=None):
+    """Replaces extension function calls with their results joining the source once"""
+    call_results = _evaluate_calls(calls, spans, awaited_results, context)
+    parts = []
+    position = 0
+    for start, end, fn_key in spans:
+        parts.append(source[position:start])
+        parts.append(str(next(call_results[fn_key])))
+        position = end
+    parts.append(source[position:])
+    return "".join(parts)
+
+
+def _evaluate_calls(calls, spans, awaited_results=None, context=None):
+    """Evaluates extension function calls. Returns an iterator over the results of every distinct call.
+
+    Calls are evaluated grouped by distinct call in order of appearance. Isolated functions are evaluated once per call
+    instance, or once per distinct call through their batch(n, args) function if they have one. The rest are evaluated
+    once per distinct call. Calls share the state of the provided load context, or of a new one, such as sequences.
+    The close functions of isolated functions are called by streamed load contexts once the whole load ends.
+    """
+    with load_context(context) as context:
+        instance_counts = collections.Counter(span[-1] for span in spans)
+        call_results = {}
+        for fn_key in calls.keys():
+            extension_function, fn_parameters = calls[fn_key]
+            fn = extension_function.fn
+            if awaited_results is not None and fn_key in awaited_results:
+                results = iter(awaited_results[fn_key])
+            else:
+                results = None
+            if extension_function.isolated:
+                if results is None and extension_function.batch is not None:
+                    # Batch capable functions produce the results of all the call instances at once
+                    results = iter(extension_function.batch(instance_counts[fn_key], fn_parameters))
+                call_results[fn_key] = iter([next(results) if results is not None else fn(*fn_parameters)
+                                             for i in range(0, instance_counts[fn_key])])
+                # Call Close Function for the Extension call
+                if extension_function.close is not None:
+                    if context.close_functions is None:
+                        extension_function.close()
+                    elif extension_function.close not in context.close_functions:
+                        context.close_functions.append(extension_function.close)
+            else:
+                call_results[fn_key] = itertools.repeat(next(results) if results is not None else fn(*fn_parameters))
+    return call_results
+
+
 def _parse_reference_calls(source: str):
-    """Parses reference calls"""
-    if _has_reference_calls(source):
-        updated_source = source
-        # Extract Source Tree and Reference Tree
-        base = _extract_tree(updated_source)
-        # Source Tree
-        source_tree = base[0]
-        # References
-        ref_calls = base[1]
-        # Reference Tree
-        ref_tree = base[2]
-        if ref_calls is not None and len(ref_calls) > 0:
-            for r in ref_calls:
-                updated_source = updated_source.replace(r, source_tree[ref_calls[r]])
-                # Update Tree when a value ref_call is updated. This guarantees references of references to get the initially referenced value.
-                source_tree = _extract_tree(updated_source, extract_ref_calls=False)[0]
-        return updated_source
-    else:
+    """Parses reference calls on the decoded source. Only the values holding references are replaced in the source,
+    so the rest of it is kept as it is and decoded once by the caller."""
+    if not _has_reference_calls(source):
         return source
+    reference_spans = _find_reference_spans(source)
+    if len(reference_spans) == 0:
+        return source
+    # Values holding references are marked with their index, so they are found back once decoded
+    parts = []
+    position = 0
+    for i, (start, end) in enumerate(reference_spans):
+        parts.append(source[position:start])
+        if source[start] == '"':
+            parts.append('"\\u0001{0}\\u0001{1}'.format(i, source[start + 1:end]))
+        else:
+            parts.append(json.dumps("{0}{1}{0}{2}{3}".format(_REFERENCE_SITE_MARKER, i, _BARE_EXPRESSION_MARKER,
+                                                             source[start:end])))
+        position = end
+    parts.append(source[position:])
+    # Numbers keep their source text, so the values they are copied to get it as it is
+    document = [json.loads(_wrap_bare_expressions("".join(parts)), parse_float=_SourceNumber,
+                           parse_int=_SourceNumber)]
+    sites = _find_sites(document)
+    site_spans = {}
+    for site in sites:
+        if site.value.startswith(_REFERENCE_SITE_MARKER):
+            marker_end = site.value.index(_REFERENCE_SITE_MARKER, 1)
+            site_spans[site.path] = reference_spans[int(site.value[1:marker_end])]
+            site.value = site.value[marker_end + 1:]
+            _set_value(document, site.path, site.value)
+    _resolve_references(document, _find_reference_sites(sites))
+    _clear_markers(document, sites)
+    # Values holding references of keys found more than once are not decoded, so they are left as they are
+    parts = []
+    position = 0
+    for path, (start, end) in sorted(site_spans.items(), key=lambda item: item[1][0]):
+        parts.append(source[position:start])
+        parts.append(_dump_source_value(_get_value(document, path)))
+        position = end
+    parts.append(source[position:])
+    return "".join(parts)
+
+
+def _find_reference_spans(source):
+    """Finds the (start, end) positions of the string values and of the bare expressions holding references"""
+    spans = []
+    match = _STRING_OR_EXPRESSION.search(source)
+    while match is not None:
+        next_position = match.end()
+        if match.group() == "$":
+            end = _find_bare_expression_close(source, match.start())
+            if end is not None:
+                if _has_reference_calls(source[match.start():end]):
+                    spans.append((match.start(), end))
+                next_position = end
+        elif _has_reference_calls(match.group()) and not _is_key(source, match.end()):
+            spans.append(match.span())
+        match = _STRING_OR_EXPRESSION.search(source, next_position)
+    return spans
+
+
+def _is_key(source, end):
+    """Whether the string ending at a position is an object key"""
+    return _KEY_SEPARATOR.match(source, end) is not None
+
+
+class _SourceNumber(str):
+    """A number decoded as its source text"""
+
+
+def _dump_source_value(value):
+    """Encodes a value into JSON keeping the source text of its numbers"""
+    if isinstance(value, _SourceNumber):
+        return str.__str__(value)
+    if isinstance(value, dict):
+        return "{" + ", ".join("{0}: {1}".format(json.dumps(k), _dump_source_value(v)) for k, v in value.items()) + "}"
+    if isinstance(value, list):
+        return "[" + ", ".join(_dump_source_value(v) for v in value) + "]"
+    return json.dumps(value)
 
 def _has_reference_calls(source:str):
     if source is not None and ("$root." in source or "$this." in source or "$parent" in source):
@@ -72,174 +302,558 @@ def _has_reference_calls(source:str):
         return False
 
 
-def _extract_tree(source: str, parent: str = None, outer_tree: dict = None, extract_ref_calls: bool = True):
-    tree = {}
-    if outer_tree is not None:
-        tree = { **outer_tree }
-    ref_list = {}
-    ref_tree = {}
-    i = 0
-    done = False
-    working_source = source
-    while not done:
-        # Done
-        if i == len(working_source):
-            done = True
+def scan_expressions(source):
+    """Finds whether a source has extension function calls and references. Returns both flags."""
+    if "$" not in source:
+        return False, False
+    return "$." in source, _has_reference_calls(source)
+
+
+def evaluate(source, raise_error_on_invalid_value=False, native_values=False, registry=None, context=None):
+    """Decodes a JSON source and evaluates its extension function calls and references on the decoded document.
+
+    With native_values, values made of a single call or reference are replaced by the result itself instead of its
+    string.
+    """
+    document = [decode(source)]
+    sites = _find_sites(document)
+    calls = {}
+    spans = _find_site_calls(sites, calls, raise_error_on_invalid_value, registry)
+    if len(spans) > 0:
+        call_results = _evaluate_calls(calls, spans, _run_coroutine_calls(calls, spans), context)
+        _apply_site_calls(document, spans, call_results, native_values)
+    _resolve_references(document, _find_reference_sites(sites), native_values=native_values)
+    _clear_markers(document, sites)
+    return document[0]
+
+
+async def aevaluate(source, raise_error_on_invalid_value=False, native_values=False, registry=None):
+    """Same as evaluate but awaits all the coroutine extension function calls concurrently"""
+    document = [decode(source)]
+    sites = _find_sites(document)
+    calls = {}
+    spans = _find_site_calls(sites, calls, raise_error_on_invalid_value, registry)
+    if len(spans) > 0:
+        awaited_results = await _await_coroutine_calls(calls, spans) if _has_coroutine_calls(calls) else None
+        _apply_site_calls(document, spans, _evaluate_calls(calls, spans, awaited_results), native_values)
+    _resolve_references(document, _find_reference_sites(sites), native_values=native_values)
+    _clear_markers(document, sites)
+    return document[0]
+
+
+def evaluate_lazily(source, raise_error_on_invalid_value=False, native_values=False, registry=None):
+    """Decodes a JSON source into a read only LazyMapping or LazySequence view. Extension function calls and
+    references are evaluated when the values holding them are first accessed."""
+    evaluation = _LazyEvaluation([decode(source)], raise_error_on_invalid_value, native_values, registry)
+    return evaluation.get(evaluation.document, (), 0)
+
+
+def decode(source):
+    """Decodes a JSON source keeping the extension function calls and references found outside of string values"""
+    return json.loads(_wrap_bare_expressions(source))
+
+
+def _wrap_bare_expressions(source):
+    """Wraps the extension function calls and references found outside of string values into marked strings"""
+    if "$" not in source:
+        return source
+    parts = []
+    position = 0
+    match = _STRING_OR_EXPRESSION.search(source)
+    while match is not None:
+        next_position = match.end()
+        if match.group() == "$":
+            end = _find_bare_expression_close(source, match.start())
+            if end is not None:
+                parts.append(source[position:match.start()])
+                parts.append(json.dumps(_BARE_EXPRESSION_MARKER + source[match.start():end]))
+                position = next_position = end
+        match = _STRING_OR_EXPRESSION.search(source, next_position)
+    parts.append(source[position:])
+    return "".join(parts)
+
+
+def _find_bare_expression_close(source, start):
+    """Gets the position following an extension function call or a reference. None if there is none."""
+    if source.startswith("$.", start):
+        return _find_call_close(source, start)
+    for prefix in _REF_PREFIXES:
+        if source.startswith(prefix, start):
+            end = start + len(prefix)
+            while end < len(source) and source[end] not in _REF_TERMINATORS:
+                end += 1
+            return end if end > start + len(prefix) else None
+    return None
+
+
+def _decode_bare_value(text):
+    """Decodes the result of an extension function call or reference found outside of string values"""
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+class _Site(object):
+    """A string value of a decoded document holding extension function calls or references"""
+    __slots__ = ("path", "this_path", "parent_path", "value")
+
+    def __init__(self, path, this_path, parent_path, value):
+        self.path = path
+        self.this_path = this_path
+        self.parent_path = parent_path
+        self.value = value
+
+
+def _find_sites(document):
+    """Finds the string values holding extension function calls or references in document order.
+
+    Documents are held in a list, so their root can be replaced as any other value. Paths are tuples of keys and
+    indexes. The object holding a value is its $this, and the object holding that one its $parent.
+    """
+    sites = []
+    stack = [(document, (), None, None)]
+    while len(stack) > 0:
+        value, path, this_path, parent_path = stack.pop()
+        if isinstance(value, dict):
+            stack.extend(reversed([(v, path + (k,), path, this_path) for k, v in value.items()]))
+        elif isinstance(value, list):
+            stack.extend(reversed([(v, path + (i,), this_path, parent_path) for i, v in enumerate(value)]))
+        elif isinstance(value, str) and "$" in value:
+            sites.append(_Site(path, this_path, parent_path, value))
+    return sites
+
+
+def _get_value(document, path):
+    for key in path:
+        document = document[key]
+    return document
+
+
+def _set_value(document, path, value):
+    _get_value(document, path[:-1])[path[-1]] = value
+
+
+def _strip_marker(value):
+    return value[1:] if value.startswith(_BARE_EXPRESSION_MARKER) else value
+
+
+def _find_site_calls(sites, calls, raise_error_on_invalid_value=False, registry=None):
+    """Finds the extension function calls of all the sites. Returns the (site, start, end, call) span of every call."""
+    unknown_calls = set()
+    spans = []
+    for site in sites:
+        if "$." in site.value:
+            site_spans = _find_calls(_strip_marker(site.value), raise_error_on_invalid_value, calls, unknown_calls,
+                                     registry)[1]
+            spans.extend((site,) + span for span in site_spans)
+    return spans
+
+
+def _apply_site_calls(document, spans, call_results, native_values=False):
+    """Replaces the extension function calls of the sites with their results in document order"""
+    for site, site_spans in itertools.groupby(spans, key=lambda span: span[0]):
+        site_spans = list(site_spans)
+        results = [next(call_results[span[3]]) for span in site_spans]
+        _set_value(document, site.path, _join_site_calls(site, site_spans, results, native_values))
+
+
+def _join_site_calls(site, site_spans, results, native_values=False):
+    """Gets the value of a site with its extension function calls replaced by their results"""
+    text = _strip_marker(site.value)
+    if native_values and len(site_spans) == 1 and site_spans[0][1] == 0 and site_spans[0][2] == len(text):
+        return results[0]
+    parts = []
+    position = 0
+    for (_, start, end, fn_key), result in zip(site_spans, results):
+        parts.append(text[position:start])
+        parts.append(str(result))
+        position = end
+    parts.append(text[position:])
+    value = "".join(parts)
+    if site.value.startswith(_BARE_EXPRESSION_MARKER):
+        return _decode_bare_value(value)
+    return value
+
+
+def _find_reference_sites(sites):
+    return [site for site in sites if _has_reference_calls(_strip_marker(site.value))]
+
+
+def _find_references(text, site):
+    """Finds the references of a site. Returns their (start, end, base path, body) in order."""
+    references = []
+    i = text.find("$")
+    while i != -1:
+        for prefix, base_path in (("$root.", (0,)), ("$this.", site.this_path), ("$parent.", site.parent_path)):
+            if text.startswith(prefix, i):
+                end = i + len(prefix)
+                while end < len(text) and text[end] not in _REF_TERMINATORS:
+                    end += 1
+                if end > i + len(prefix) and base_path is not None:
+                    references.append((i, end, base_path, text[i + len(prefix):end]))
+                i = end - 1
+                break
+        i = text.find("$", i + 1)
+    return references
+
+
+def _match_reference_key(node, segment):
+    """Gets the key of the node the reference segment refers to, the longest one it starts with"""
+    if isinstance(node, dict):
+        if segment in node:
+            return segment
+        for length in range(len(segment) - 1, 0, -1):
+            if segment[:length] in node:
+                return segment[:length]
+    elif isinstance(node, list) and segment.isdigit() and int(segment) < len(node):
+        return int(segment)
+    return None
+
+
+def _find_reference_target(document, base_path, body, pending=None):
+    """Finds the longest path of the document the reference body starts with. The rest of the body is kept as text.
+
+    Returns the path and its length in the body. The walk stops at the pending sites, whose values are not resolved.
+    """
+    path = base_path
+    node = _get_value(document, path)
+    length = 0
+    start = 0
+    while start < len(body):
+        if pending is not None and path in pending and isinstance(node, str):
+            break
+        segment_end = body.find(".", start)
+        if segment_end == -1:
+            segment_end = len(body)
+        segment = body[start:segment_end]
+        key = _match_reference_key(node, segment)
+        if key is None:
+            break
+        path = path + (key,)
+        node = node[key]
+        length = start + len(str(key))
+        if length < segment_end:
+            break
+        start = segment_end + 1
+    return (path, length) if length > 0 else None
+
+
+def _resolve_references(document, sites, dynamic_paths=None, native_values=False):
+    """Resolves the references of the sites on the decoded document.
+
+    A graph of the values every reference depends on is built, and references are resolved in topological order so
+    referenced values are always resolved first. References depending on the values at the dynamic paths are left
+    unresolved. Their sites are returned.
+    """
+    if len(sites) == 0:
+        return []
+    pending = {site.path: site for site in sites}
+    dynamic_prefixes = set()
+    for path in dynamic_paths or ():
+        dynamic_prefixes.update(path[:i] for i in range(0, len(path) + 1))
+    # Nodes are the site paths, and the paths of the referenced objects and arrays depending on the sites they hold
+    dependencies = {}
+    dynamic = set()
+    nested = None
+    for site in sites:
+        value = _get_value(document, site.path)
+        site_dependencies = dependencies[site.path] = []
+        if not isinstance(value, str):
             continue
-        src_char = working_source[i]
-        if src_char in [' ', '\n', '\t']:
-            i = i + 1
+        if site.path in dynamic_prefixes:
+            dynamic.add(site.path)
+        for start, end, base_path, body in _find_references(_strip_marker(value), site):
+            target = _find_reference_target(document, base_path, body, pending)
+            if target is None:
+                continue
+            target_path = target[0]
+            if target_path in dynamic_prefixes:
+                dynamic.add(site.path)
+            if target_path in pending:
+                site_dependencies.append(target_path)
+            elif isinstance(_get_value(document, target_path), (dict, list)):
+                if nested is None:
+                    nested = _find_nested_sites(sites)
+                if target_path not in dependencies:
+                    dependencies[target_path] = nested.get(target_path, [])
+                site_dependencies.append(target_path)
+    # Resolve in topological order
+    dependents = {}
+    remaining = {}
+    for node, node_dependencies in dependencies.items():
+        remaining[node] = len(node_dependencies)
+        for dependency in node_dependencies:
+            dependents.setdefault(dependency, []).append(node)
+    ready = collections.deque(node for node in dependencies if remaining[node] == 0)
+    resolved_count = 0
+    while len(ready) > 0:
+        node = ready.popleft()
+        resolved_count += 1
+        if node in dynamic or any(dependency in dynamic for dependency in dependencies[node]):
+            dynamic.add(node)
+        elif node in pending:
+            _resolve_site_references(document, pending[node], native_values)
+        for dependent in dependents.get(node, ()):
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                ready.append(dependent)
+    if resolved_count < len(dependencies):
+        raise ReferenceRecursionError(_find_reference_cycle(dependencies, remaining))
+    return [site for site in sites if site.path in dynamic]
+
+
+def _find_nested_sites(sites):
+    """Maps the path of every object and array to the paths of the sites it holds"""
+    nested = {}
+    for site in sites:
+        for i in range(0, len(site.path)):
+            nested.setdefault(site.path[:i], []).append(site.path)
+    return nested
+
+
+def _find_reference_cycle(dependencies, remaining):
+    """Finds a cycle among the nodes that could not be resolved. Returns its paths."""
+    node = next(node for node in remaining if remaining[node] > 0)
+    visited = []
+    while node not in visited:
+        visited.append(node)
+        node = next(dependency for dependency in dependencies[node] if remaining[dependency] > 0)
+    return visited[visited.index(node):]
+
+
+def _resolve_site_references(document, site, native_values=False):
+    """Replaces the references of a site by the values they refer to, which must be already resolved"""
+    value = _get_value(document, site.path)
+    bare = value.startswith(_BARE_EXPRESSION_MARKER)
+    text = _strip_marker(value)
+    parts = []
+    position = 0
+    for start, end, base_path, body in _find_references(text, site):
+        target = _find_reference_target(document, base_path, body)
+        if target is None:
             continue
-        # Find property assignments
-        elif src_char == ":":
-            source_key_scope = working_source[:i]
-            try:
-                source_key_start_index = source_key_scope.rindex(',')
-            except:
-                source_key_start_index = source_key_scope.rindex("{")
-            source_key = source_key_scope[source_key_start_index:].replace('"', '').replace(' ', '').replace('\t',
-                                                                                                             '').replace(
-                '\n', '').replace('{', '').replace(',', '')
-            if parent is not None and parent != "":
-                source_key = f"{parent}.{source_key}"
-            source_value_scope = working_source[i:]
-            # Find arrays
-            if source_value_scope.replace(' ', '').replace('\t', '')[1] == '[':
-                source_value_end_index = source_value_scope.index("]") + 1
-            elif source_value_scope.replace(' ', '').replace('\t', '')[1] == "{":
-                source_value_end_index = source_value_scope.index("}") + 1
-            else:
-                try:
-                    source_value_end_index = source_value_scope.index(",")
-                except:
-                    source_value_end_index = source_value_scope.index("}")
-            source_value = source_value_scope[1:source_value_end_index].strip(' ').strip('\t').strip('\n').strip('"')
-            # Process Object
-            if source_value[0] == "{" and source_value[-1] == "}":
-                inner_object_tree = _extract_tree(source_value, source_key, tree)
-                for inner_object_key in inner_object_tree[0]:
-                    full_key = f"{source_key}.{inner_object_key.replace(source_key, '')}".replace("..", ".")
-                    tree[full_key] = inner_object_tree[0][inner_object_key]
-                    # Reference Tree
-                    ref_tree[full_key] = _get_abs_ref_tree_entry(full_key, source_key)
-                    # Extract Ref Calls
-                    if extract_ref_calls:
-                        if inner_object_tree[1] is not None:
-                            for k in inner_object_tree[1]:
-                                if k not in ref_list:
-                                    ref_list[k] = inner_object_tree[1][k]
-            # Set the Value
-            tree[source_key] = source_value
-            # Reference tree
-            ref_tree[source_key] = _get_abs_ref_tree_entry(source_key, parent)
-            # Extract References
-            if extract_ref_calls:
-                tree_keys = [k for k in tree.keys()]
-                ref_call = _extract_ref_call(source_value, tree_keys, source_key)
-                ref_call = _get_abs_ref_call_from_ref_tree(ref_tree, ref_call)
-                if ref_call is not None:
-                    if ref_call[5] in tree_keys:
-                        if ref_call[0] not in ref_list:
-                            ref_list[ref_call[0]] = ref_call[5]
+        target_path, length = target
+        target_value = _get_value(document, target_path)
+        reference_end = end - len(body) + length
+        if (bare or native_values) and start == 0 and reference_end == len(text):
+            # A reference found outside of string values is replaced by the value itself
+            _set_value(document, site.path, copy.deepcopy(target_value))
+            return
+        parts.append(text[position:start])
+        parts.append(target_value if isinstance(target_value, str) else _dump_source_value(target_value))
+        position = reference_end
+    parts.append(text[position:])
+    _set_value(document, site.path, _decode_bare_value("".join(parts)) if bare else "".join(parts))
+
+
+def _clear_markers(document, sites):
+    """Turns the extension function calls and references found outside of string values that were left into strings"""
+    for site in sites:
+        value = _get_value(document, site.path)
+        if isinstance(value, str) and value.startswith(_BARE_EXPRESSION_MARKER):
+            _set_value(document, site.path, value[1:])
+
+
+class Template(object):
+    """A document decoded once. Rendering it evaluates only its extension function calls and the references depending
+    on them."""
+
+    def __init__(self, source, raise_error_on_invalid_value=False, native_values=False, registry=None):
+        self._native_values = native_values
+        document = [decode(source)]
+        sites = _find_sites(document)
+        self._calls = {}
+        self._spans = _find_site_calls(sites, self._calls, raise_error_on_invalid_value, registry)
+        call_paths = set(span[0].path for span in self._spans)
+        # References to static values are resolved once
+        self._reference_sites = _resolve_references(document, _find_reference_sites(sites), call_paths, native_values)
+        dynamic_paths = call_paths.union(site.path for site in self._reference_sites)
+        self._dynamic_sites = [site for site in sites if site.path in dynamic_paths]
+        _clear_markers(document, [site for site in sites if site.path not in dynamic_paths])
+        self._document = document
+
+    def render(self):
+        """Evaluates the dynamic values into a new document. Documents are copies, so changing one does not change the
+        ones rendered next."""
+        document = _copy_tree(self._document)
+        if len(self._spans) > 0:
+            awaited_results = _run_coroutine_calls(self._calls, self._spans)
+            call_results = _evaluate_calls(self._calls, self._spans, awaited_results)
+            _apply_site_calls(document, self._spans, call_results, self._native_values)
+        if len(self._reference_sites) > 0:
+            _resolve_references(document, self._reference_sites, native_values=self._native_values)
+        _clear_markers(document, self._dynamic_sites)
+        return document[0]
+
+
+def _copy_tree(value):
+    """Copies the dictionaries and lists of a decoded document. Faster than copy.deepcopy as other values are kept."""
+    if isinstance(value, dict):
+        return {k: _copy_tree(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_tree(v) for v in value]
+    return value
+
+
+class _LazyEvaluation(object):
+    """Evaluates the extension function calls and references of a decoded document as its values are accessed.
+
+    Results are kept in the document, so every value is evaluated once and gets the same result as an eager evaluation.
+    Isolated functions are evaluated for all their calls at once, in document order.
+    """
+
+    def __init__(self, document, raise_error_on_invalid_value=False, native_values=False, registry=None):
+        self.document = document
+        self._native_values = native_values
+        self._lock = threading.RLock()
+        sites = _find_sites(document)
+        self._sites = {site.path: site for site in sites}
+        self._calls = {}
+        self._site_spans = {}
+        self._instance_spans = {}
+        for span in _find_site_calls(sites, self._calls, raise_error_on_invalid_value, registry):
+            self._site_spans.setdefault(span[0].path, []).append(span)
+            self._instance_spans.setdefault(span[3], []).append(span)
+        self._results = {}
+        self._context = LoadContext()
+
+    def get(self, container, path, key):
+        """Gets a value of a container, evaluating it first if needed"""
+        value = container[key]
+        path = path + (key,)
+        if path in self._sites:
+            self._resolve([path])
+            value = container[key]
+        if isinstance(value, dict):
+            return LazyMapping(self, path, value)
+        if isinstance(value, list):
+            return LazySequence(self, path, value)
+        return value
+
+    def materialize(self, path):
+        """Evaluates all the values at and below a path. Returns a copy of them as dictionaries and lists."""
+        with self._lock:
+            self._resolve([p for p in self._sites if p[:len(path)] == path])
+            return copy.deepcopy(_get_value(self.document, path))
+
+    def _resolve(self, paths):
+        # Evaluates the sites along with all the sites they depend on, resolving their references in dependency order
+        with self._lock:
+            sites = []
+            queue = collections.deque(path for path in paths if path in self._sites)
+            queued = set(queue)
+            while len(queue) > 0:
+                site = self._sites[queue.popleft()]
+                sites.append(site)
+                self._apply_calls(site)
+                value = _get_value(self.document, site.path)
+                if not isinstance(value, str):
+                    continue
+                for start, end, base_path, body in _find_references(_strip_marker(value), site):
+                    target = _find_reference_target(self.document, base_path, body, self._sites)
+                    if target is None or len(queued) == len(self._sites):
+                        continue
+                    target_path = target[0]
+                    if target_path in self._sites or not isinstance(_get_value(self.document, target_path),
+                                                                    (dict, list)):
+                        dependencies = [target_path]
                     else:
-                        # TODO: Review incremental key verification
-                        i = 0
-                        found = False
-                        ref_call_base = ref_call[5]
-                        ref_call_temp = ref_call_base
-                        while True:
-                            if i > len(ref_call_base):
-                                break
-                            if ref_call_temp in tree_keys:
-                                found = True
-                                break
-                            ref_call_temp = ref_call_base[:i]
-                            i = i + 1
-                        if found:
-                            ref_call_new = ()
-                            for r in range(0, len(ref_call)):
-                                ref_call_new_value = ref_call[r]
-                                if r == 5:
-                                    ref_call_new_value = ref_call_temp
-                                else:
-                                    ref_call_last_element_index = -1
-                                    ref_call_elements = ref_call_temp.split('.')
-                                    ref_call_last_element = ref_call_elements[-1]
-                                    if len(ref_call_elements) > 1:
-                                        try:
-                                            ref_call_last_element_index = ref_call[r].index(ref_call_last_element)
-                                        except:
-                                            pass
-                                        if ref_call_last_element_index > 0:
-                                            ref_call_last_element_index = ref_call_last_element_index + len(ref_call_last_element)
-                                        ref_call_new_value = ref_call[r][:ref_call_last_element_index]
-                                    else:
-                                        ref_call_new_value = ref_call[r]
-                                ref_call_new = ref_call_new + (ref_call_new_value,)
-                            if ref_call_new[0] not in ref_list:
-                                ref_list[ref_call_new[0]] = ref_call_temp
-
-            # Reset
-            working_source = working_source[i + source_value_end_index:]
-            i = 0
-            continue
-        # Next Character
-        i = i + 1
-    return (tree, ref_list, ref_tree)
+                        dependencies = [p for p in self._sites if p[:len(target_path)] == target_path]
+                    for dependency in dependencies:
+                        if dependency in self._sites and dependency not in queued:
+                            queued.add(dependency)
+                            queue.append(dependency)
+            _resolve_references(self.document, _find_reference_sites(sites), native_values=self._native_values)
+            _clear_markers(self.document, sites)
+            for site in sites:
+                del self._sites[site.path]
 
+    def _apply_calls(self, site):
+        site_spans = self._site_spans.pop(site.path, None)
+        if site_spans is None:
+            return
+        for fn_key in set(span[3] for span in site_spans):
+            if fn_key not in self._results:
+                instance_spans = self._instance_spans[fn_key]
+                calls = {fn_key: self._calls[fn_key]}
+                awaited_results = _run_coroutine_calls(calls, instance_spans)
+                results = _evaluate_calls(calls, instance_spans, awaited_results, self._context)[fn_key]
+                self._results[fn_key] = {span: next(results) for span in instance_spans}
+        results = [self._results[span[3]][span] for span in site_spans]
+        _set_value(self.document, site.path, _join_site_calls(site, site_spans, results, self._native_values))
 
-def _extract_ref_call(source: str, keys: list, caller:str):
-    if _has_reference_calls(source):
-        ref_call_without_prefix = ""
-        ref_start_index = source.index("$")
-        working_source = source[ref_start_index:].replace('"', "").strip(' ')
-        try:
-            ref_prefix_end = working_source.index(".")
-        except:
-            return None
-        ref_call_prefix = working_source[:ref_prefix_end]
-        working_source = working_source[ref_prefix_end + 1:]
-        i = 0
-        while i < len(working_source):
-            if working_source[i] in ['"', '\n', '\t', ' ', '$', '}', ']', ',', '|']:
-                break
-            ref_call_without_prefix = ref_call_without_prefix + working_source[i]
-            if ref_call_without_prefix in keys:
-                break
-            i = i + 1
-        if ref_call_prefix != "" and ref_call_without_prefix != "":
-            ref_call = f"{ref_call_prefix}.{ref_call_without_prefix}"
-            return (ref_call, ref_call_without_prefix, ref_call_prefix, caller)
-        else:
-            return None
-    else:
-        return None
 
+class LazyMapping(collections.abc.Mapping):
+    """Read only view of a decoded object evaluating its values when they are first accessed"""
+    __slots__ = ("_evaluation", "_path", "_value")
 
-def _get_abs_ref_tree_entry(source_key: str, parent_key: str):
-    """Get Absolute path to reference prefixes"""
-    this = source_key
-    parent = parent_key
-    if '.' in source_key:
-        this = '.'.join(source_key.split(".")[:-1])
-        parent = '.'.join(source_key.split(".")[:-2])
-        if parent != "" and parent[-1] == ".":
-            parent = parent[:-1]
-    return {
-        "parent": parent,
-        "this": this
-    }
-
-def _get_abs_ref_call_from_ref_tree(ref_tree:dict, ref_call:tuple):
-    if ref_tree is not None and ref_call is not None:
-        if '$this' in ref_call[2]:
-            return ref_call + (ref_tree[ref_call[3]]["this"], f"{ref_tree[ref_call[3]]['this']}.{ref_call[1]}")
-        elif '$parent' in ref_call[2]:
-            return ref_call + (ref_tree[ref_call[3]]["this"], f"{ref_tree[ref_call[3]]['parent']}.{ref_call[1]}")
-        else:
-            return ref_call + (ref_call[1],ref_call[1])
-    else:
-        if ref_call is not None:
-            return ref_call + (ref_call[1],ref_call[1])
-        else:
-            return None
+    def __init__(self, evaluation, path, value):
+        self._evaluation = evaluation
+        self._path = path
+        self._value = value
+
+    def __getitem__(self, key):
+        return self._evaluation.get(self._value, self._path, key)
+
+    def __iter__(self):
+        return iter(self._value)
+
+    def __len__(self):
+        return len(self._value)
+
+    def __repr__(self):
+        return repr(self.materialize())
+
+    def materialize(self):
+        """Evaluates all the values. Returns them as a dictionary."""
+        return self._evaluation.materialize(self._path)
+
+
+class LazySequence(collections.abc.Sequence):
+    """Read only view of a decoded array evaluating its values when they are first accessed"""
+    __slots__ = ("_evaluation", "_path", "_value")
+
+    def __init__(self, evaluation, path, value):
+        self._evaluation = evaluation
+        self._path = path
+        self._value = value
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._value)))]
+        if index < 0:
+            index += len(self._value)
+        if index < 0:
+            raise IndexError("list index out of range")
+        return self._evaluation.get(self._value, self._path, index)
+
+    def __len__(self):
+        return len(self._value)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, LazySequence)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.materialize())
+
+    def materialize(self):
+        """Evaluates all the values. Returns them as a list."""
+        return self._evaluation.materialize(self._path)
+
+
+class ReferenceRecursionError(Exception):
+    def __init__(self, origin=None):
+        super().__init__()
+        self._origin = origin
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return "Reference Recursion Found in values {0}.".format(
+            " -> ".join(".".join(str(key) for key in path[1:]) for path in self._origin))
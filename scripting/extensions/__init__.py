@@ -1,38 +1,108 @@
-import inspect
+import collections
+import functools
+import importlib
+import threading
 
-from scripting.extensions.cryptography import uuidv4, md5, sha1, sha256, sha512
-from scripting.extensions.datetime import now, now_add, now_utc, now_utc_add
-from scripting.extensions.sequences import sequence
-from scripting.extensions.io import file_checksum
-
-# Functions Dict
-# This is ok for now since the list of functions is short. But further refactoring may be required if it grows.
+# Standard Functions Dict, mapping each function to the module implementing it. Modules are imported on first use.
 # Warning: When adding functions please do not include the closing parenthesis as seen in existing ones.
 
-_functions = {
-    "$.now": now,
-    "$.now().add": now_add,
-    "$.now().utc": now_utc,
-    "$.now().utc().add": now_utc_add,
-    "$.uuid": uuidv4,
-    "$.md5": md5,
-    "$.sha1": sha1,
-    "$.sha256": sha256,
-    "$.sha512": sha512,
-    "$.sequence": sequence,
-    '$.file_checksum': file_checksum,
+_STANDARD_FUNCTIONS = {
+    "$.now": ("scripting.extensions.datetime", "now"),
+    "$.now().add": ("scripting.extensions.datetime", "now_add"),
+    "$.now().utc": ("scripting.extensions.datetime", "now_utc"),
+    "$.now().utc().add": ("scripting.extensions.datetime", "now_utc_add"),
+    "$.uuid": ("scripting.extensions.cryptography", "uuidv4"),
+    "$.md5": ("scripting.extensions.cryptography", "md5"),
+    "$.sha1": ("scripting.extensions.cryptography", "sha1"),
+    "$.sha256": ("scripting.extensions.cryptography", "sha256"),
+    "$.sha512": ("scripting.extensions.cryptography", "sha512"),
+    "$.sequence": ("scripting.extensions.sequences", "sequence"),
+    '$.file_checksum': ("scripting.extensions.io", "file_checksum"),
 }
 
+# Registered extension function and the way its calls are evaluated. Isolated functions are evaluated once per call
+# instance, through their batch(n, args) function if they have one, and then closed.
+_ExtensionFunction = collections.namedtuple("_ExtensionFunction", ["fn", "batch", "isolated", "close"])
+
+
 def get_function(func_call):
     """Gets an extension function from a raw function call"""
-    fn_key = func_call[:func_call.rfind('('):]
-    fn_parameters_str = func_call[func_call.rfind('(') + 1:func_call.rfind(')')]
+    return _DEFAULT_REGISTRY.get_function(func_call)
+
+
+def get_default_registry():
+    """Gets the process wide extension registry used by loads not provided with one"""
+    return _DEFAULT_REGISTRY
+
+
+@functools.lru_cache(maxsize=None)
+def _import_function(module_name, fn_name):
+    """Imports the implementation of a standard extension function. Its module defines how its calls are evaluated."""
+    fn = getattr(importlib.import_module(module_name), fn_name)
+    return _ExtensionFunction(fn, getattr(fn, "batch", None), getattr(fn, "_isolated_instance_execution", False),
+                              getattr(fn, "_close", None))
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_call(func_call):
+    """Parses a raw function call into its key and its parameters. Every distinct call is parsed once."""
+    fn_key, fn_parameters_str = _split_call(func_call)
     if fn_parameters_str.strip(' ') == "":
-        fn_parameters = []
-    else:
-        fn_parameters = [remove_quotation(v) for v in fn_parameters_str.split(",")]
-    if fn_key in _functions.keys():
-        return (_functions[fn_key], fn_parameters)
+        return fn_key, ()
+    return fn_key, tuple(remove_quotation(v.strip(' ')) for v in _split_parameters(fn_parameters_str))
+
+
+def _split_call(func_call):
+    """Splits a raw function call into its key and its parameters, the ones of its last chained call"""
+    parameters_start = func_call.rfind('(')
+    depth = 0
+    quote = None
+    i = 0
+    while i < len(func_call):
+        char = func_call[i]
+        if quote is not None:
+            if char == "\\":
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char == "'" or char == '"':
+            quote = char
+        elif char == "(":
+            if depth == 0:
+                parameters_start = i
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        i += 1
+    return func_call[:parameters_start], func_call[parameters_start + 1:func_call.rfind(')')]
+
+
+def _split_parameters(parameters_str):
+    """Splits raw function parameters by the commas found outside of quotes and parentheses"""
+    parameters = []
+    depth = 0
+    quote = None
+    parameter_start = 0
+    i = 0
+    while i < len(parameters_str):
+        char = parameters_str[i]
+        if quote is not None:
+            if char == "\\":
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char == "'" or char == '"':
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parameters.append(parameters_str[parameter_start:i])
+            parameter_start = i + 1
+        i += 1
+    parameters.append(parameters_str[parameter_start:])
+    return parameters
 
 
 def remove_quotation(value):
@@ -46,14 +116,69 @@ def remove_quotation(value):
     return result
 
 
-def register_extension_function(name, fn):
-    """Register Custom Extension Function"""
-    global _functions
-    fn_name = f"$.{name}"
-    if fn_name in _functions.keys():
-        raise Exception(f"Extension Function with name {fn_name} is already registered.")
-    else:
+def register_extension_function(name, fn, batch=None):
+    """Register Custom Extension Function. When a batch function is provided, it gets the values of all the calls with
+    the same parameters at once, given their count and the parameters."""
+    _DEFAULT_REGISTRY.register(name, fn, batch)
+
+
+class ExtensionRegistry(object):
+    """Set of extension functions available to the loads using it. Starts with the standard functions unless other
+    functions are provided, mapped by name."""
+
+    def __init__(self, functions=None):
+        self._lock = threading.Lock()
+        if functions is None:
+            self._functions = dict(_STANDARD_FUNCTIONS)
+        else:
+            self._functions = {}
+            for name, fn in functions.items():
+                self.register(name, fn)
+
+    def get_function(self, func_call):
+        """Gets an extension function and its parameters from a raw function call. None if it is not registered."""
+        call = self.get_call(func_call)
+        if call is None:
+            return None
+        return (call[0].fn, call[1])
+
+    def get_call(self, func_call):
+        """Gets the registered extension function, with the way its calls are evaluated, and its parameters from a raw
+        function call. None if it is not registered."""
+        fn_key, fn_parameters = _parse_call(func_call)
+        extension_function = self._functions.get(fn_key)
+        if extension_function is None:
+            return None
+        if not isinstance(extension_function, _ExtensionFunction):
+            extension_function = _import_function(*extension_function)
+        return (extension_function, fn_parameters)
+
+    def names(self):
+        """Gets the names of the registered functions"""
+        return [fn_key[2:] for fn_key in self._functions]
+
+    def register(self, name, fn, batch=None, replace=False):
+        """Registers an extension function. Registering an existing name raises an error unless replace is set."""
+        fn_name = f"$.{name}"
+        import inspect
         fn_info = inspect.getfullargspec(fn)
         if fn_info.varargs is None:
             raise Exception(f"Provided Extension Function with name {fn_name} does not accept parameters. It must have at least an *arg parameter defined.")
-        _functions[fn_name] = fn
\ No newline at end of file
+        # Functions are not changed, so the same one can be registered in many registries. Functions setting
+        # _isolated_instance_execution or _close themselves keep being evaluated that way.
+        extension_function = _ExtensionFunction(fn, batch,
+                                                batch is not None or getattr(fn, "_isolated_instance_execution", False),
+                                                getattr(fn, "_close", None))
+        with self._lock:
+            if fn_name in self._functions and not replace:
+                raise Exception(f"Extension Function with name {fn_name} is already registered.")
+            # Functions are replaced by a new table, so concurrent lookups always see a complete one
+            self._functions = {**self._functions, fn_name: extension_function}
+
+    def unregister(self, name):
+        """Removes an extension function"""
+        with self._lock:
+            self._functions = {k: v for k, v in self._functions.items() if k != f"$.{name}"}
+
+
+_DEFAULT_REGISTRY = ExtensionRegistry()
@@ -0,0 +1,43 @@
+import contextlib
+import contextvars
+
+_LOAD_CONTEXT = contextvars.ContextVar("load_context", default=None)
+
+
+class LoadContext(object):
+    """State shared by the extension function calls of a single load"""
+
+    def __init__(self, streamed=False):
+        self.sequences = {}
+        # Date and time the first $.now call of the load got
+        self.now = None
+        # Close functions of the isolated functions called by a streamed load, called once the whole load ends
+        self.close_functions = [] if streamed else None
+
+    def close(self):
+        """Calls the close functions of a streamed load"""
+        close_functions = self.close_functions or []
+        self.close_functions = []
+        for close_function in close_functions:
+            close_function()
+
+
+def get_load_context():
+    """Gets the context of the running load. Calls made outside of a load get a new context each, so they do not share
+    the date and time of $.now calls."""
+    context = _LOAD_CONTEXT.get()
+    if context is None:
+        return LoadContext()
+    return context
+
+
+@contextlib.contextmanager
+def load_context(context=None):
+    """Runs extension function calls in the provided load context or in a new one"""
+    if context is None:
+        context = LoadContext()
+    token = _LOAD_CONTEXT.set(context)
+    try:
+        yield context
+    finally:
+        _LOAD_CONTEXT.reset(token)
@@ -1,7 +1,9 @@
-from datetime import datetime, timedelta
+import functools
+from datetime import datetime, timedelta, timezone
 
 from dateutil.tz import tzlocal
 
+from scripting.extensions.context import get_load_context
 from scripting.extensions.tools import is_windows
 
 
@@ -67,17 +69,21 @@ _DATETIME_FORMAT_MAP = [
     ("Z", "%Y-%m-%dT%H:%m:%s.%f%z", None)  # Full ISO-8601
 ]
 
-_formats_cache = {}
+# Longest tokens are matched first
+_FORMAT_TOKENS = sorted(_DATETIME_FORMAT_MAP, key=lambda t: len(t[0]), reverse=True)
 
 
 def _get_now():
-    """Gets current date, time and local timezone"""
-    return datetime.now(tzlocal())
+    """Gets the date and time the load started at, in the local timezone. All the calls of a load get the same one."""
+    context = get_load_context()
+    if context.now is None:
+        context.now = datetime.now(tzlocal())
+    return context.now
 
 
 def _get_now_utc():
-    """Gets current UTC date and time"""
-    return datetime.utcnow()
+    """Gets the UTC date and time the load started at"""
+    return _get_now().astimezone(timezone.utc).replace(tzinfo=None)
 
 
 def now(*args):
@@ -178,37 +184,35 @@ def _add_time(date, *args):
 
 def _format(dt: datetime, format=None):
     """Formats the provided datetime. Default ISO8601+TZ."""
-    global _formats_cache
     if format is not None:
-        if format not in _formats_cache.keys():
-            _formats_cache[format] = _convert_universal_format(format)
-        result = dt.strftime(_formats_cache[format][0])
-        _token_handlers = _formats_cache[format][1]
-        if _token_handlers is not None:
-            for token in _token_handlers:
-                result = result.replace(token, str(_token_handlers[token](dt)))
-        return result
+        return "".join(dt.strftime(python_format) if python_format is not None else str(handler(dt))
+                       for python_format, handler in _compile_format(format))
     if dt.utcoffset() is None:
         return dt.isoformat() + "-00:00"
     else:
         return dt.isoformat()
 
 
-def _convert_universal_format(format):
-    """Converts Universal Date Time Format to Python strftime format string"""
+@functools.lru_cache(maxsize=256)
+def _compile_format(format):
+    """Compiles a Universal Date Time Format into an immutable plan of strftime formats and calculated tokens"""
+    plan = []
+    python_formats = []
     i = 0
-    token_string = format
-    python_format = format
-    token_map = sorted(_DATETIME_FORMAT_MAP, key=lambda t: t[0], reverse=True)
-    calculated_tokens = {}
-    for f in token_map:
-        if f[0] in token_string:
-            if f[1] is None and f[2] is not None and hasattr(f[2], '__call__'):
-                if f[0] not in calculated_tokens.keys():
-                    calculated_tokens[f[0]] = f[2]
-            else:
-                token_string = token_string.replace(f[0], "")
-                python_format = python_format.replace(f[0], f[1])
-            del token_map[i]
-        i += 1
-    return python_format, calculated_tokens
+    while i < len(format):
+        token = next((t for t in _FORMAT_TOKENS if format.startswith(t[0], i)), None)
+        if token is None:
+            python_formats.append(format[i].replace("%", "%%"))
+            i += 1
+            continue
+        if token[1] is not None:
+            python_formats.append(token[1])
+        else:
+            if len(python_formats) > 0:
+                plan.append(("".join(python_formats), None))
+                python_formats = []
+            plan.append((None, token[2]))
+        i += len(token[0])
+    if len(python_formats) > 0:
+        plan.append(("".join(python_formats), None))
+    return tuple(plan)
@@ -1,9 +1,27 @@
+from scripting.extensions.context import get_load_context
 from scripting.extensions.tools import get_null_value
 
-_SEQUENCE_CACHE = {}
-
 
 def sequence(*args):
+    return _sequence(*_get_sequence_arguments(args))
+
+
+def sequence_batch(n, args):
+    """Gets the next n values of a sequence at once"""
+    sequences = get_load_context().sequences
+    sequence_key, format, step = _get_sequence_arguments(args)
+    if sequence_key is None or sequence_key == "":
+        raise AttributeError("Sequence Id most be provided")
+    step = int(step) if step is not None else 1
+    start = sequences.get(sequence_key, 0)
+    sequences[sequence_key] = start + step * n
+    values = range(start + step, start + step * n + 1, step) if step != 0 else [start] * n
+    if format is not None and format != "":
+        return [format.format(value) for value in values]
+    return list(values)
+
+
+def _get_sequence_arguments(args):
     if len(args) == 0:
         raise AttributeError("Sequence Id most be provided")
     format = None
@@ -12,31 +30,33 @@ def sequence(*args):
     step = 1
     if len(args) > 2:
         step = get_null_value(args[2])
-    return _sequence(args[0], format, step)
+    return args[0], format, step
 
 
 def _sequence(sequence_key, format=None, step=None):
-    global _SEQUENCE_CACHE
+    sequences = get_load_context().sequences
     if sequence_key is None or sequence_key == "":
         raise AttributeError("Sequence Id most be provided")
-    if sequence_key not in _SEQUENCE_CACHE:
-        _SEQUENCE_CACHE[sequence_key] = 0
+    if sequence_key not in sequences:
+        sequences[sequence_key] = 0
     if step is None:
         step = 1
-    _SEQUENCE_CACHE[sequence_key] += int(step)
+    sequences[sequence_key] += int(step)
     # If format is provided using {0} placeholder apply it
     if format is not None and format != "":
-        return format.format(_SEQUENCE_CACHE[sequence_key])
-    return _SEQUENCE_CACHE[sequence_key]
+        return format.format(sequences[sequence_key])
+    return sequences[sequence_key]
 
 
 def _close_sequences():
-    """Resets sequence on dictionary"""
-    global _SEQUENCE_CACHE
-    for sequence_key in _SEQUENCE_CACHE:
-        _SEQUENCE_CACHE[sequence_key] = 0
+    """Resets the sequences of the running load"""
+    sequences = get_load_context().sequences
+    for sequence_key in sequences:
+        sequences[sequence_key] = 0
 
 
 # Parser will run each call by it self and not evaluate one instance and update all calls with the result
 sequence._isolated_instance_execution = True
 sequence._close = _close_sequences
+# All the values of a sequence found in a document are generated at once
+sequence.batch = sequence_batch
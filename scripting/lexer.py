@@ -0,0 +1,27 @@
+import re
+
+# String literals are matched only to skip them, so comment markers found inside them (such as urls) are kept. Runs of
+# code and string literals without comments are matched at once, so sources with few comments are matched few times.
+_TOKENS = re.compile(r'(?:[^"/]+|"[^"\\\n]*(?:\\.[^"\\\n]*)*"|/(?![/*]))+|(//[^\n]*|/\*.*?\*/)', re.DOTALL)
+
+
+def find_comments(source):
+    """Finds all the comments outside of string literals in a single pass. Returns their (start, end) positions."""
+    if "//" not in source and "/*" not in source:
+        return []
+    return [match.span(1) for match in _TOKENS.finditer(source) if match.start(1) != -1]
+
+
+def remove_comments(source, comments=None):
+    """Removes all the comments outside of string literals. Comments found by find_comments can be provided."""
+    if comments is None:
+        comments = find_comments(source)
+    if len(comments) == 0:
+        return source
+    parts = []
+    position = 0
+    for start, end in comments:
+        parts.append(source[position:start])
+        position = end
+    parts.append(source[position:])
+    return "".join(parts)
@@ -105,11 +105,9 @@ setup(
         # 'Programming Language :: Python :: 2',
         # 'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
     ],
 
     # This field adds keywords for your project which will appear on the
@@ -129,6 +127,9 @@ setup(
     #
     packages=find_packages(exclude=['contrib', 'docs', 'tests', 'dist', 'build']),  # Required
 
+    # Load contexts rely on contextvars and the asyncio API on asyncio.get_running_loop, both added in Python 3.7.
+    python_requires='>=3.7',
+
     project_urls={  # Optional
         'Bug Reports': 'https://github.com/prods/exjson/issues',
         #'Funding': 'https://donate.pypi.org',
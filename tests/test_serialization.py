@@ -1,13 +1,22 @@
+import asyncio
+import hashlib
+import http.server
 import json
 import os
 import re
+import shutil
+import tempfile
+import threading
+import time
 from datetime import datetime, timedelta
+from decimal import Decimal
 from unittest import TestCase
 
 from dateutil.tz import tzlocal
 
 import exjson
 from tests.tools.callgraph import generate_call_graph
+from tests.tools.importtime import measure_import
 
 __author__ = 'prods'
 __project__ = 'exjson'
@@ -24,6 +33,37 @@ def get_sample_json_file_path(file_name):
     return os.path.join(get_sample_dir_path(), file_name)
 
 
+class SamplesHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves the sample files"""
+    protocol_version = "HTTP/1.1"
+
+    def translate_path(self, path):
+        return os.path.join(get_sample_dir_path(), path.split('?', 1)[0].lstrip('/'))
+
+    def log_message(self, format, *args):
+        pass
+
+    def log_request(self, code='-', size='-'):
+        self.server.requests.append((self.path, int(code)))
+        self.server.clients.add(self.client_address)
+
+
+def start_samples_http_server(handler_class=SamplesHTTPRequestHandler):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    server.requests = []
+    server.clients = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_async(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
 class EXJSONTestScenarios(object):
 
     @generate_call_graph
@@ -73,6 +113,14 @@ class EXJSONTestScenarios(object):
         }
         """, encoding='utf-8')
 
+    @generate_call_graph
+    def loads_json_include_from_http_url_with_max_age(self, json_source, includes_path, http_max_age=None):
+        return exjson.loads(json_source, encoding='utf-8', includes_path=includes_path, http_max_age=http_max_age)
+
+    @generate_call_graph
+    def loads_json_include_from_http_url_with_fetcher(self, json_source, includes_path, http_fetcher):
+        return exjson.loads(json_source, encoding='utf-8', includes_path=includes_path, http_fetcher=http_fetcher)
+
     @generate_call_graph
     def load_json_in_different_positions(self):
         return exjson.load(get_sample_json_file_path("multi-include.json"), encoding='utf-8')
@@ -101,6 +149,15 @@ class EXJSONTestScenarios(object):
     def loads_json_includes_followed_by_comment_before_EOF(self, json_source):
         return exjson.loads(json_source, encoding='utf-8')
 
+    @generate_call_graph
+    def loads_json_same_include_repeated(self, json_source):
+        return exjson.loads(json_source, encoding='utf-8', includes_path=get_sample_dir_path())
+
+    @generate_call_graph
+    def loads_json_include_with_checksum(self, json_source, includes_path=None):
+        return exjson.loads(json_source, encoding='utf-8', includes_path=includes_path or get_sample_dir_path(),
+                            error_on_include_file_not_found=True)
+
     @generate_call_graph
     def loads_json_missing_include_raises_an_error(self, json_source):
         return exjson.loads(json_source, encoding='utf-8', includes_path=get_sample_dir_path(),
@@ -121,14 +178,67 @@ class EXJSONTestScenarios(object):
         return exjson.load(get_sample_json_file_path("multi-level-include/multi-level-include-recursive-first.json"),
                            encoding='utf-8')
 
+    @generate_call_graph
+    def load_json_with_include_cache(self, file_path, include_cache):
+        return exjson.load(file_path, encoding='utf-8', include_cache=include_cache)
+
+    @generate_call_graph
+    def load_json_with_include_graph(self, file_path, include_graph, include_cache=None):
+        return exjson.load(file_path, encoding='utf-8', include_graph=include_graph, include_cache=include_cache)
+
+    @generate_call_graph
+    def reload_json_if_changed(self, reloader):
+        return reloader.poll()
+
+    @generate_call_graph
+    def load_json_with_cache_dir(self, file_path, cache_dir):
+        return exjson.load(file_path, encoding='utf-8', cache_dir=cache_dir)
+
+    @generate_call_graph
+    def load_json_prefetching_includes(self, file_path, max_workers=None):
+        return exjson.load(file_path, encoding='utf-8', prefetch_includes=True, max_workers=max_workers)
+
+    @generate_call_graph
+    def loads_json_prefetching_includes(self, json_source, max_workers=None):
+        return exjson.loads(json_source, encoding='utf-8', includes_path=get_sample_dir_path(),
+                            prefetch_includes=True, max_workers=max_workers)
+
+    @generate_call_graph
+    def aload_json(self, file_path):
+        return run_async(exjson.aload(file_path, encoding='utf-8'))
+
+    @generate_call_graph
+    def aloads_json(self, json_source, includes_path=None, max_concurrency=10, extension_registry=None):
+        return run_async(exjson.aloads(json_source, encoding='utf-8', includes_path=includes_path,
+                                       max_concurrency=max_concurrency, extension_registry=extension_registry))
+
     @generate_call_graph
     def loads_json_without_property_override_raises_an_error(self, json_source):
         return exjson.loads(json_source, encoding='utf-8', includes_path=get_sample_dir_path())
 
     @generate_call_graph
-    def loads_json_evaluate(self, json_source, test_name=None):
+    def loads_json_evaluate(self, json_source, test_name=None, extension_registry=None):
         __name__ = test_name
-        return exjson.loads(json_source, encoding='utf-8', includes_path=get_sample_dir_path())
+        return exjson.loads(json_source, encoding='utf-8', includes_path=get_sample_dir_path(),
+                            extension_registry=extension_registry)
+
+    @generate_call_graph
+    def loads_json_evaluate_native_values(self, json_source, **kw):
+        return exjson.loads(json_source, encoding='utf-8', includes_path=get_sample_dir_path(), native_values=True,
+                            **kw)
+
+    @generate_call_graph
+    def loads_json_evaluate_lazily(self, json_source, extension_registry=None):
+        return exjson.loads(json_source, encoding='utf-8', includes_path=get_sample_dir_path(), lazy=True,
+                            extension_registry=extension_registry)
+
+    @generate_call_graph
+    def compile_json(self, json_source):
+        return exjson.compile(json_source, encoding='utf-8', includes_path=get_sample_dir_path())
+
+    @generate_call_graph
+    def iterload_json(self, json_file_path, prefix, chunk_size):
+        return list(exjson.iterload(json_file_path, prefix, encoding='utf-8', chunk_size=chunk_size))
 
     @generate_call_graph
     def loads_json_evaluate_raw_date_value(self, json_source, test_name=None):
@@ -347,6 +457,33 @@ class TestEXJSONSerialization(TestCase):
             "Enabled": True
         })
 
+    def test_loads_json_string_with_comment_markers_in_string_values(self):
+        result = self._scenarios.loads_json_string_with_comments("""{
+            // Comment
+            "Url": "https://raw.githubusercontent.com/prods/exjson", /* Comment */
+            "Pattern": "/* not a comment */",
+            "Quoted": "// \\"/* not a comment */\\"",
+            "Directive": "/* #INCLUDE <missing.json> */"
+        } // Comment without a trailing new line""")
+        self.assertDictEqual(result, {
+            "Url": "https://raw.githubusercontent.com/prods/exjson",
+            "Pattern": "/* not a comment */",
+            "Quoted": "// \"/* not a comment */\"",
+            "Directive": "/* #INCLUDE <missing.json> */"
+        })
+
+    def test_loads_plain_json_string(self):
+        json_source = """{
+            "Url": "https://raw.githubusercontent.com/prods/exjson",
+            "Price": "$5 / $6",
+            "Path": "a/b",
+            "Values": [1.5, 2, null]
+        }"""
+        self.assertDictEqual(self._scenarios.loads_simple_json_string(json_source), json.loads(json_source))
+        self.assertEqual(list(exjson.loads(json_source, object_pairs_hook=list)), list(json.loads(json_source).items()))
+        self.assertDictEqual(exjson.loads(json_source, native_values=True), json.loads(json_source))
+        self.assertDictEqual(run_async(exjson.aloads(json_source)), json.loads(json_source))
+
     def test_loads_json_with_comments_and_included_files(self):
         with open(get_sample_json_file_path("pipeline.json"), encoding="utf-8") as f:
             json_source = f.read()
@@ -513,6 +650,28 @@ class TestEXJSONSerialization(TestCase):
             }
         })
 
+    def test_loads_json_same_include_repeated(self):
+        json_source = """{
+            "Values": [
+                /* #INCLUDE <multi-include.001.json> */
+                /* #INCLUDE <multi-include.001.json> */
+            ]
+            }
+            """
+        result = self._scenarios.loads_json_same_include_repeated(json_source)
+        self.assertDictEqual(result, {
+            "Values": [
+                {
+                    "Value_id": "0AEC4D9BC52AB96E424CD057A59CC45EFF314107",
+                    "Value": "test message 1"
+                },
+                {
+                    "Value_id": "0AEC4D9BC52AB96E424CD057A59CC45EFF314107",
+                    "Value": "test message 1"
+                }
+            ]
+        })
+
     def test_loads_json_missing_include_raises_an_error(self):
         result = None
         with open(get_sample_json_file_path("multi-include-with-missing-ref.json"), encoding="utf-8") as f:
@@ -599,6 +758,172 @@ class TestEXJSONSerialization(TestCase):
             "Enabled": True
         })
 
+    def test_loads_json_include_from_http_url_revalidates_downloaded_file(self):
+        server = start_samples_http_server()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            json_source = """{
+                /* #INCLUDE <Post:http://127.0.0.1:%s/clean-simple.json|{}> */
+            }""" % server.server_port
+            expected = exjson.load(get_sample_json_file_path("clean-simple.json"))
+            result = self._scenarios.loads_json_include_from_http_url_with_max_age(json_source, temp_dir)
+            self.assertDictEqual(result["Post"], expected)
+            info_dir = os.path.join(temp_dir, ".downloads", "urls")
+            info_file_name = [n for n in os.listdir(info_dir) if n.endswith(".http.json")][0]
+            with open(os.path.join(info_dir, info_file_name)) as f:
+                self.assertIsNotNone(json.load(f)["last_modified"])
+            # Unchanged file is not downloaded again
+            result = self._scenarios.loads_json_include_from_http_url_with_max_age(json_source, temp_dir)
+            self.assertDictEqual(result["Post"], expected)
+            self.assertListEqual([code for _, code in server.requests], [200, 304])
+            # Recently validated file is reused without any request
+            result = self._scenarios.loads_json_include_from_http_url_with_max_age(json_source, temp_dir, 3600)
+            self.assertDictEqual(result["Post"], expected)
+            self.assertEqual(len(server.requests), 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(temp_dir)
+
+    def test_loads_json_include_from_http_url_stores_downloads_by_content(self):
+        server = start_samples_http_server()
+        temp_dir = tempfile.mkdtemp()
+        download_dir = os.path.join(temp_dir, "downloads")
+        try:
+            url = "http://127.0.0.1:{0}".format(server.server_port)
+            json_source = """{
+                /* #INCLUDE <Post:%s/clean-simple.json|{}> */
+                /* #INCLUDE <Copy:%s/clean-simple.json?copy=1|{}> */
+            }""" % (url, url)
+            expected = exjson.load(get_sample_json_file_path("clean-simple.json"))
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(
+                exjson.loads(json_source, includes_path=temp_dir, download_dir=download_dir))) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(results), 8)
+            for result in results:
+                self.assertDictEqual(result, {"Post": expected, "Copy": expected})
+            # Both urls share the same stored file
+            self.assertListEqual(os.listdir(os.path.join(download_dir, "objects")),
+                                 ["cf5c54e08ad3c8c57d1d98e7622e8e93.json"])
+            self.assertEqual(len([n for n in os.listdir(os.path.join(download_dir, "urls"))
+                                  if n.endswith(".http.json")]), 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(temp_dir)
+
+    def test_loads_json_include_from_http_url_reuses_connections(self):
+        server = start_samples_http_server()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            url = "http://127.0.0.1:{0}".format(server.server_port)
+            json_source = """{
+                /* #INCLUDE <Post:%s/clean-simple.json|{}> */
+                /* #INCLUDE <Stage:%s/pipeline.stage.001.json|{}> */
+                /* #INCLUDE <Other:%s/multi-include.001.json|{}> */
+            }""" % (url, url, url)
+            with exjson.HTTPFetcher() as fetcher:
+                result = self._scenarios.loads_json_include_from_http_url_with_fetcher(json_source, temp_dir, fetcher)
+                self.assertEqual(result["Stage"]["Name"], "First Stage")
+                self._scenarios.loads_json_include_from_http_url_with_fetcher(json_source, temp_dir, fetcher)
+            self.assertEqual(len(server.requests), 6)
+            self.assertEqual(len(server.clients), 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(temp_dir)
+
+    def test_loads_json_include_from_http_url_retries_unavailable_server(self):
+        class UnavailableOnceHTTPRequestHandler(SamplesHTTPRequestHandler):
+            def do_GET(self):
+                if not self.server.requests:
+                    self.send_error(503)
+                else:
+                    super().do_GET()
+
+        server = start_samples_http_server(UnavailableOnceHTTPRequestHandler)
+        temp_dir = tempfile.mkdtemp()
+        try:
+            json_source = """{
+                /* #INCLUDE <Post:http://127.0.0.1:%s/clean-simple.json> */
+            }""" % server.server_port
+            with exjson.HTTPFetcher(retries=1, backoff=0) as fetcher:
+                result = self._scenarios.loads_json_include_from_http_url_with_fetcher(json_source, temp_dir, fetcher)
+            self.assertDictEqual(result["Post"], exjson.load(get_sample_json_file_path("clean-simple.json")))
+            self.assertListEqual([code for _, code in server.requests], [503, 200])
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(temp_dir)
+
+    def test_loads_json_include_validates_checksum(self):
+        with open(get_sample_json_file_path("clean-simple.json"), "rb") as f:
+            content = f.read()
+        expected = exjson.load(get_sample_json_file_path("clean-simple.json"))
+        for checksum in [hashlib.md5(content).hexdigest(),
+                         hashlib.md5(content).hexdigest().upper(),
+                         hashlib.sha256(content).hexdigest(),
+                         "sha256:" + hashlib.sha256(content).hexdigest(),
+                         hashlib.blake2b(content).hexdigest(),
+                         "blake2b:" + hashlib.blake2b(content).hexdigest()]:
+            for json_source in ["{\n/* #INCLUDE <Post:clean-simple.json|{}|%s> */\n}" % checksum,
+                                "[\n/* #INCLUDE <clean-simple.json|{}|%s> */\n]" % checksum]:
+                result = self._scenarios.loads_json_include_with_checksum(json_source)
+                self.assertEqual(result["Post"] if isinstance(result, dict) else result[0], expected)
+        for checksum in ["cf5c54e08ad3c8c57d1d98e7622e8e94", "sha1:" + hashlib.sha1(content).hexdigest()]:
+            try:
+                self._scenarios.loads_json_include_with_checksum(
+                    "{\n/* #INCLUDE <Post:clean-simple.json|{}|%s> */\n}" % checksum)
+                self.fail()
+            except exjson.IncludeError as ex:
+                self.assertTrue("clean-simple.json" in str(ex))
+
+    def test_loads_json_include_from_http_url_with_checksum_is_served_offline(self):
+        server = start_samples_http_server()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            json_source = """{
+                /* #INCLUDE <Post:http://127.0.0.1:%s/clean-simple.json|{}|cf5c54e08ad3c8c57d1d98e7622e8e93> */
+            }""" % server.server_port
+            expected = exjson.load(get_sample_json_file_path("clean-simple.json"))
+            self.assertDictEqual(self._scenarios.loads_json_include_with_checksum(json_source, temp_dir)["Post"],
+                                 expected)
+            server.shutdown()
+            server.server_close()
+            self.assertDictEqual(self._scenarios.loads_json_include_with_checksum(json_source, temp_dir)["Post"],
+                                 expected)
+            self.assertEqual(len(server.requests), 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(temp_dir)
+
+    def test_loads_json_include_from_http_url_with_sha256_checksum_is_served_offline(self):
+        server = start_samples_http_server()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            with open(get_sample_json_file_path("clean-simple.json"), "rb") as f:
+                checksum = hashlib.sha256(f.read()).hexdigest()
+            json_source = """{
+                /* #INCLUDE <Post:http://127.0.0.1:%s/clean-simple.json|{}|sha256:%s> */
+            }""" % (server.server_port, checksum)
+            expected = exjson.load(get_sample_json_file_path("clean-simple.json"))
+            self.assertDictEqual(self._scenarios.loads_json_include_with_checksum(json_source, temp_dir)["Post"],
+                                 expected)
+            server.shutdown()
+            server.server_close()
+            self.assertDictEqual(self._scenarios.loads_json_include_with_checksum(json_source, temp_dir)["Post"],
+                                 expected)
+            self.assertEqual(len(server.requests), 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(temp_dir)
+
     # Multi-Level Include
 
     def test_loads_json_with_multi_level_include(self):
@@ -639,6 +964,268 @@ class TestEXJSONSerialization(TestCase):
         except exjson.IncludeRecursionError as ex:
             self.assertTrue("multi-level-include-recursive-first.json" in str(ex))
 
+    # Include Cache
+
+    def test_load_json_with_include_cache_reuses_fragments(self):
+        include_cache = exjson.IncludeCache()
+        file_path = get_sample_json_file_path("multi-level-include/multi-level-include-main.json")
+        first = self._scenarios.load_json_with_include_cache(file_path, include_cache)
+        second = self._scenarios.load_json_with_include_cache(file_path, include_cache)
+        self.assertDictEqual(first, second)
+        self.assertDictEqual(first, self._scenarios.loads_json_with_multi_level_include())
+        stats = include_cache.stats()
+        self.assertEqual(stats["entries"], 3)
+        self.assertEqual(stats["hits"], 3)
+        include_cache.clear()
+        self.assertEqual(include_cache.stats()["entries"], 0)
+
+    def test_load_json_with_include_cache_detects_changed_nested_fragment(self):
+        include_cache = exjson.IncludeCache()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(temp_dir, "main.json"), "w") as f:
+                f.write('{\n  "Name": "Main"\n  // #INCLUDE <Stage:stage.json>\n}')
+            with open(os.path.join(temp_dir, "stage.json"), "w") as f:
+                f.write('{\n  "Name": "Stage"\n  // #INCLUDE <Step:step.json>\n}')
+            with open(os.path.join(temp_dir, "step.json"), "w") as f:
+                f.write('{"Name": "Step 1"}')
+            result = self._scenarios.load_json_with_include_cache(os.path.join(temp_dir, "main.json"), include_cache)
+            self.assertEqual(result["Stage"]["Step"]["Name"], "Step 1")
+            with open(os.path.join(temp_dir, "step.json"), "w") as f:
+                f.write('{"Name": "Step 1 Updated"}')
+            result = self._scenarios.load_json_with_include_cache(os.path.join(temp_dir, "main.json"), include_cache)
+            self.assertEqual(result["Stage"]["Step"]["Name"], "Step 1 Updated")
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_load_json_with_include_cache_detects_recursion(self):
+        include_cache = exjson.IncludeCache()
+        for i in range(0, 2):
+            with self.assertRaises(exjson.IncludeRecursionError):
+                self._scenarios.load_json_with_include_cache(
+                    get_sample_json_file_path("multi-level-include/multi-level-include-recursive-first.json"),
+                    include_cache)
+
+    def test_include_cache_evicts_least_recently_used_fragments(self):
+        include_cache = exjson.IncludeCache(max_bytes=400)
+        include_cache.put("a", "a" * 100, {})
+        include_cache.put("b", "b" * 100, {})
+        self.assertIsNotNone(include_cache.get("a"))
+        include_cache.put("c", "c" * 100, {})
+        self.assertIsNotNone(include_cache.get("a"))
+        self.assertIsNone(include_cache.get("b"))
+        self.assertEqual(include_cache.stats()["evictions"], 1)
+
+    # Concurrent Include Prefetch
+
+    def test_load_json_prefetching_includes(self):
+        for file_name in ["pipeline.json", "multi-include.json", "multi-level-include/multi-level-include-main.json"]:
+            file_path = get_sample_json_file_path(file_name)
+            self.assertDictEqual(self._scenarios.load_json_prefetching_includes(file_path, max_workers=2),
+                                 exjson.load(file_path, encoding='utf-8'))
+
+    def test_loads_json_prefetching_includes_with_missing_file_default_value(self):
+        with open(get_sample_json_file_path("multi-include-with-missing-ref.json"), encoding="utf-8") as f:
+            json_source = f.read()
+        result = self._scenarios.loads_json_prefetching_includes(json_source)
+        self.assertEqual(len(result["Values"]), 1)
+        self.assertEqual(result["Other3"]["Value"], "test message 2")
+
+    def test_load_json_prefetching_includes_detects_recursion(self):
+        try:
+            self._scenarios.load_json_prefetching_includes(
+                get_sample_json_file_path("multi-level-include/multi-level-include-recursive-first.json"))
+            self.fail()
+        except exjson.IncludeRecursionError as ex:
+            self.assertTrue("multi-level-include-recursive-first.json" in str(ex))
+
+    # Asyncio API
+
+    def test_aload_json_with_comments_and_included_files(self):
+        result = self._scenarios.aload_json(get_sample_json_file_path("pipeline.json"))
+        self.assertDictEqual(result, self._scenarios.load_json_with_comments_and_included_files())
+
+    def test_aloads_json_include_from_local_http_server(self):
+        server = start_samples_http_server()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            url = "http://127.0.0.1:{0}".format(server.server_port)
+            result = self._scenarios.aloads_json("""{
+                "Name": "First Stage",
+                /* #INCLUDE <Post:%s/clean-simple.json|{}> */
+                /* #INCLUDE <Stage:%s/pipeline.stage.001.json|{}> */
+                "Enabled": true
+            }""" % (url, url), includes_path=temp_dir, max_concurrency=1)
+            self.assertDictEqual(result["Post"], exjson.load(get_sample_json_file_path("clean-simple.json")))
+            self.assertEqual(result["Stage"]["Name"], "First Stage")
+            self.assertTrue(result["Enabled"])
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(temp_dir)
+
+    def test_aloads_json_awaits_coroutine_extension_functions_together(self):
+        running = {"current": 0, "max": 0}
+
+        async def delayed_value(*args):
+            running["current"] += 1
+            running["max"] = max(running["max"], running["current"])
+            await asyncio.sleep(0.01)
+            running["current"] -= 1
+            return args[0]
+
+        registry = exjson.ExtensionRegistry()
+        registry.register("async_delayed_value", delayed_value)
+        result = self._scenarios.aloads_json("""{
+            "a": "$.async_delayed_value('1')",
+            "b": "$.async_delayed_value('2')"
+        }""", extension_registry=registry)
+        self.assertDictEqual(result, {"a": "1", "b": "2"})
+        self.assertEqual(running["max"], 2)
+        # Also supported by the synchronous API
+        result = self._scenarios.loads_json_evaluate("""{
+            "a": "$.async_delayed_value('3')"
+        }""", extension_registry=registry)
+        self.assertDictEqual(result, {"a": "3"})
+
+    def test_aload_json_with_cache_dir_awaits_cached_volatile_values(self):
+        async def tagged_value(*args):
+            await asyncio.sleep(0)
+            return "tag-" + args[0]
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cache_dir = os.path.join(temp_dir, "cache")
+            file_path = os.path.join(temp_dir, "volatile.json")
+            with open(file_path, "w") as f:
+                f.write('{\n  // Volatile values\n  "tag": "$.async_tagged_value(\'A\')",\n  "n": $.sequence(\'A\')\n}')
+            registry = exjson.ExtensionRegistry()
+            registry.register("async_tagged_value", tagged_value)
+            for native_values in [False, True]:
+                for i in range(0, 2):
+                    result = asyncio.run(exjson.aload(file_path, cache_dir=cache_dir, native_values=native_values,
+                                                      extension_registry=registry))
+                    self.assertDictEqual(result, {"tag": "tag-A", "n": 1})
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    # Include Graph
+
+    def test_load_json_with_include_graph(self):
+        file_path = get_sample_json_file_path("multi-level-include/multi-level-include-main.json")
+        include_cache = exjson.IncludeCache()
+        for _ in range(2):
+            # The second load gets the graph of the cached fragments
+            graph = exjson.IncludeGraph()
+            self._scenarios.load_json_with_include_graph(file_path, graph, include_cache)
+            self.assertEqual(graph.root, os.path.abspath(file_path))
+            self.assertListEqual([os.path.basename(n) for n in graph.nodes()], [
+                "multi-level-include-main.json",
+                "multi-level-include-001.json",
+                "multi-level-include-002.json",
+                "multi-level-include-003.json"
+            ])
+            self.assertListEqual([os.path.basename(n) for n in graph.includes(graph.root)], [
+                "multi-level-include-001.json",
+                "multi-level-include-002.json",
+                "multi-level-include-003.json"
+            ])
+            level3 = graph.nodes()[3]
+            with open(level3, "rb") as f:
+                self.assertEqual(graph.checksum(level3), hashlib.md5(f.read()).hexdigest())
+            self.assertListEqual([os.path.basename(n) for n in graph.included_by(level3)],
+                                 ["multi-level-include-main.json", "multi-level-include-002.json"])
+            self.assertEqual(len(graph.dependents(level3)), 3)
+            self.assertListEqual(graph.changed(), [])
+        self.assertEqual(include_cache.stats()["hits"], 3)
+
+    def test_reloader_reloads_changed_included_files_only(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(temp_dir, "main.json"), "w") as f:
+                f.write('{\n  /* #INCLUDE <A:a.json> */\n  /* #INCLUDE <B:b.json> */\n}')
+            with open(os.path.join(temp_dir, "a.json"), "w") as f:
+                f.write('{"Value": "a"}')
+            with open(os.path.join(temp_dir, "b.json"), "w") as f:
+                f.write('{"Value": "b"}')
+            include_cache = exjson.IncludeCache()
+            reloader = exjson.Reloader(os.path.join(temp_dir, "main.json"), include_cache=include_cache)
+            self.assertDictEqual(reloader.document, {"A": {"Value": "a"}, "B": {"Value": "b"}})
+            self.assertFalse(self._scenarios.reload_json_if_changed(reloader))
+            with open(os.path.join(temp_dir, "b.json"), "w") as f:
+                f.write('{"Value": "b changed"}')
+            self.assertListEqual(reloader.graph.changed(), [os.path.join(temp_dir, "b.json")])
+            self.assertTrue(self._scenarios.reload_json_if_changed(reloader))
+            self.assertDictEqual(reloader.document, {"A": {"Value": "a"}, "B": {"Value": "b changed"}})
+            self.assertListEqual(reloader.graph.changed(), [])
+            # Only the changed file was expanded again
+            self.assertEqual(include_cache.stats()["hits"], 1)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    # Document Cache
+
+    def test_load_json_with_cache_dir_reuses_resolved_document(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cache_dir = os.path.join(temp_dir, "cache")
+            shutil.copy(get_sample_json_file_path("pipeline.json"), temp_dir)
+            shutil.copy(get_sample_json_file_path("pipeline.stage.001.json"), temp_dir)
+            file_path = os.path.join(temp_dir, "pipeline.json")
+            first = self._scenarios.load_json_with_cache_dir(file_path, cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            second = self._scenarios.load_json_with_cache_dir(file_path, cache_dir)
+            self.assertDictEqual(first, second)
+            self.assertDictEqual(first, self._scenarios.load_json_with_comments_and_included_files())
+            # Changing an included file invalidates the cached document
+            with open(os.path.join(temp_dir, "pipeline.stage.001.json"), "w") as f:
+                f.write('{"Name": "Changed Stage"}')
+            third = self._scenarios.load_json_with_cache_dir(file_path, cache_dir)
+            self.assertEqual(third["Stages"][0]["Name"], "Changed Stage")
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_load_json_with_cache_dir_evaluates_volatile_values_on_every_load(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cache_dir = os.path.join(temp_dir, "cache")
+            file_path = os.path.join(temp_dir, "volatile.json")
+            with open(file_path, "w") as f:
+                f.write('{\n  // Volatile values\n  "id": "$.uuid()",\n  "n": $.sequence(\'A\'),\n  "name": "Volatile"\n}')
+            first = self._scenarios.load_json_with_cache_dir(file_path, cache_dir)
+            second = self._scenarios.load_json_with_cache_dir(file_path, cache_dir)
+            self.assertNotEqual(first["id"], second["id"])
+            self.assertEqual(first["n"], 1)
+            self.assertEqual(second["n"], 1)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_load_json_with_cache_dir_hashes_files_as_they_were_read(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cache_dir = os.path.join(temp_dir, "cache")
+            file_path = os.path.join(temp_dir, "document.json")
+            included_file_path = os.path.join(temp_dir, "included.json")
+            with open(file_path, "w") as f:
+                f.write('{\n  "touched": "$.touch_included()",\n  // #INCLUDE <included.json>\n}')
+            with open(included_file_path, "w") as f:
+                f.write('"name": "Read"')
+
+            def touch_included(*args):
+                # The included file changes after it was read, while the document is being loaded
+                with open(included_file_path, "w") as included_file:
+                    included_file.write('"name": "Changed"')
+                return "yes"
+
+            registry = exjson.ExtensionRegistry({"touch_included": touch_included})
+            first = exjson.load(file_path, cache_dir=cache_dir, extension_registry=registry)
+            self.assertEqual(first["name"], "Read")
+            second = exjson.load(file_path, cache_dir=cache_dir, extension_registry=registry)
+            self.assertEqual(second["name"], "Changed")
+        finally:
+            shutil.rmtree(temp_dir)
+
     # Dynamic and Reference Value Evaluation
 
     def test_loads_json_evaluate_uuid_value(self):
@@ -677,6 +1264,23 @@ class TestEXJSONSerialization(TestCase):
              }""", "sha512")
         self.assertIsNotNone(result["hash"])
 
+    def test_loads_json_evaluate_calls_with_nested_parentheses_and_string_arguments(self):
+        result = self._scenarios.loads_json_evaluate("""{
+             "hash": "$.md5('a, (b)')", "same": "$.md5('a, (b)')", "other": "$.md5('x)')",
+             "unknown": "$.unknown('a')", "path": "$.Stages.FirstStage"
+             }""")
+        self.assertEqual(result["hash"], hashlib.md5("a, (b)".encode("utf-8")).hexdigest())
+        self.assertEqual(result["same"], result["hash"])
+        self.assertEqual(result["other"], hashlib.md5("x)".encode("utf-8")).hexdigest())
+        self.assertEqual(result["unknown"], "$.unknown('a')")
+        self.assertEqual(result["path"], "$.Stages.FirstStage")
+
+    def test_loads_json_evaluate_many_calls(self):
+        result = self._scenarios.loads_json_evaluate(
+            "[" + ",".join(["""{"id": "$.uuid()", "n": $.sequence('A')}"""] * 5000) + "]")
+        self.assertListEqual([v["n"] for v in result], list(range(1, 5001)))
+        self.assertEqual(len(set(v["id"] for v in result)), 1)
+
     def test_loads_json_evaluate_raw_date_value(self):
         result = self._scenarios.loads_json_evaluate_raw_date_value("""{
             "date": "$.now()"
@@ -723,6 +1327,13 @@ class TestEXJSONSerialization(TestCase):
         # print(f"EXP: {v}  RESULT: {result['date']}")
         self.assertTrue(result["date"] == v)
 
+    def test_now_extension_function_called_outside_of_a_load_is_not_pinned(self):
+        for func_call in ("$.now('ss.f')", "$.now().utc('ss.f')"):
+            fn, fn_parameters = exjson.get_extension_registry().get_function(func_call)
+            first = fn(*fn_parameters)
+            time.sleep(0.01)
+            self.assertNotEqual(fn(*fn_parameters), first)
+
     def test_loads_json_evaluate_python_formatted_now_add_date_value(self):
         result = self._scenarios.loads_json_evaluate_raw_date_value("""{
                     "date": "$.now('yyyy-MM-dd HH:mm')"
@@ -737,6 +1348,20 @@ class TestEXJSONSerialization(TestCase):
         v = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d %H:%M")
         self.assertTrue(result["date"] == v)
 
+    def test_loads_json_evaluate_date_values_from_the_same_clock(self):
+        result = self._scenarios.loads_json_evaluate_raw_date_value("""{
+                    "iso": "$.now()",
+                    "time": "$.now('HH:mm:ss.f')",
+                    "seconds": "$.now('f ss')",
+                    "utc": "$.now().utc('mm:ss.f')",
+                    "text": "$.now('100% yyyy W')"
+                    }""")
+        now = datetime.fromisoformat(result["iso"])
+        self.assertEqual(result["time"], now.strftime("%H:%M:%S.%f"))
+        self.assertEqual(result["seconds"], now.strftime("%f %S"))
+        self.assertEqual(result["utc"], now.strftime("%M:%S.%f"))
+        self.assertEqual(result["text"], "100% {0} {1}".format(now.year, now.isocalendar()[1]))
+
     def test_load_json_evaluate_sequence_single_int(self):
         result = self._scenarios.loads_json_evaluate("""{
                             "first": [
@@ -882,6 +1507,141 @@ class TestEXJSONSerialization(TestCase):
             "a": "30"
         })
 
+    def test_loads_json_evaluate_sequences_in_concurrent_loads(self):
+        json_source = "[" + ", ".join(["$.sequence('A')", "\"$.sequence('A', '{0:0>4}')\""] * 200) + "]"
+        expected = list(range(1, 201)) + ["{0:0>4}".format(i) for i in range(1, 201)]
+        barrier = threading.Barrier(8)
+        results = []
+
+        def load():
+            barrier.wait()
+            for i in range(0, 20):
+                results.append(self._scenarios.loads_json_evaluate(json_source))
+
+        threads = [threading.Thread(target=load) for i in range(0, 8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 160)
+        for result in results:
+            self.assertListEqual(result[0::2] + result[1::2], expected)
+
+    def test_loads_json_evaluate_with_scoped_extension_registries(self):
+        first = exjson.ExtensionRegistry()
+        second = exjson.ExtensionRegistry({"tenant": lambda *args: "second"})
+        first.register("tenant", lambda *args: "first")
+        json_source = """{ "tenant": "$.tenant()", "hash": "$.md5('a')" }"""
+        self.assertDictEqual(exjson.loads(json_source, extension_registry=first),
+                             {"tenant": "first", "hash": hashlib.md5(b"a").hexdigest()})
+        self.assertDictEqual(exjson.loads(json_source, extension_registry=second),
+                             {"tenant": "second", "hash": "$.md5('a')"})
+        self.assertDictEqual(exjson.loads(json_source), {"tenant": "$.tenant()", "hash": hashlib.md5(b"a").hexdigest()})
+        with self.assertRaises(Exception):
+            first.register("tenant", lambda *args: "again")
+        first.register("tenant", lambda *args: "again", replace=True)
+        self.assertEqual(exjson.compile(json_source, extension_registry=first).render()["tenant"], "again")
+        first.unregister("tenant")
+        self.assertNotIn("tenant", first.names())
+        self.assertIsInstance(exjson.get_extension_registry(), exjson.ExtensionRegistry)
+
+    def test_loads_json_evaluate_register_custom_batch_extension_function(self):
+        batches = []
+
+        def custom_ticket(*args):
+            return custom_ticket_batch(1, args)[0]
+
+        def custom_ticket_batch(n, args):
+            batches.append((n, list(args)))
+            return ["{0}-{1}".format(args[0], i) for i in range(0, n)]
+
+        registry = exjson.ExtensionRegistry()
+        registry.register("test_ticket", custom_ticket, batch=custom_ticket_batch)
+        result = self._scenarios.loads_json_evaluate("""{
+                "a": "$.test_ticket('T')", "b": "$.test_ticket('T')", "c": ["$.test_ticket('T')", "$.test_ticket('U')"],
+                "d": [$.sequence('A', null, 5), $.sequence('A', null, 5), $.sequence('A', null, 5)]
+            }""", extension_registry=registry)
+        self.assertDictEqual(result, {"a": "T-0", "b": "T-1", "c": ["T-2", "U-0"], "d": [5, 10, 15]})
+        self.assertListEqual(batches, [(3, ["T"]), (1, ["U"])])
+
+    def test_loads_json_evaluate_custom_isolated_extension_function(self):
+        counter = {"value": 0, "closed": 0}
+
+        def custom_counter(*args):
+            counter["value"] += 1
+            return str(counter["value"])
+
+        def close_counter():
+            counter["value"] = 0
+            counter["closed"] += 1
+
+        custom_counter._isolated_instance_execution = True
+        custom_counter._close = close_counter
+        registry = exjson.ExtensionRegistry()
+        registry.register("test_counter", custom_counter)
+        json_source = """{ "values": ["$.test_counter()", "$.test_counter()", "$.test_counter()"] }"""
+        self.assertDictEqual(exjson.loads(json_source, extension_registry=registry), {"values": ["1", "2", "3"]})
+        self.assertDictEqual(exjson.loads(json_source, extension_registry=registry), {"values": ["1", "2", "3"]})
+        self.assertEqual(counter["closed"], 2)
+
+    def test_loads_json_evaluate_extension_function_registered_in_many_registries(self):
+        class Tickets(object):
+            def __init__(self):
+                self.count = 0
+
+            def next(self, *args):
+                self.count += 1
+                return "{0}-{1}".format(args[0], self.count)
+
+            def next_batch(self, n, args):
+                return [self.next(*args) for i in range(0, n)]
+
+        tickets = Tickets()
+        batched = exjson.ExtensionRegistry({})
+        shared = exjson.ExtensionRegistry({})
+        batched.register("ticket", tickets.next, batch=tickets.next_batch)
+        shared.register("ticket", tickets.next)
+        json_source = """{ "a": "$.ticket('T')", "b": "$.ticket('T')" }"""
+        self.assertDictEqual(exjson.loads(json_source, extension_registry=batched), {"a": "T-1", "b": "T-2"})
+        self.assertDictEqual(exjson.loads(json_source, extension_registry=shared), {"a": "T-3", "b": "T-3"})
+        self.assertFalse(hasattr(tickets.next, "batch"))
+
+    def test_loads_json_evaluate_native_values(self):
+        def custom_add(*args):
+            return sum(int(r) for r in args)
+
+        def custom_quote(*args):
+            return 'say "{0}"'.format(args[0])
+
+        registry = exjson.ExtensionRegistry()
+        registry.register("test_add", custom_add)
+        registry.register("test_quote", custom_quote)
+        json_source = """{
+                "a": "$.test_add(10, 20)",
+                "b": "total $.test_add(1, 2)",
+                "c": $.test_add(3, 4),
+                "d": "$.test_quote('hi')",
+                "e": [ "$.sequence('A')", "$.sequence('A')" ],
+                "f": "$root.a",
+                "g": "$root.a items"
+            }"""
+        expected = {
+            "a": 30,
+            "b": "total 3",
+            "c": 7,
+            "d": 'say "hi"',
+            "e": [1, 2],
+            "f": 30,
+            "g": "30 items"
+        }
+        self.assertDictEqual(self._scenarios.loads_json_evaluate_native_values(json_source,
+                                                                               extension_registry=registry), expected)
+        self.assertDictEqual(run_async(exjson.aloads(json_source, native_values=True, extension_registry=registry)),
+                             expected)
+        result = self._scenarios.loads_json_evaluate_native_values(json_source, parse_int=float,
+                                                                   extension_registry=registry)
+        self.assertIsInstance(result["a"], float)
+
     def test_load_json_evaluate_root_references(self):
         result = self._scenarios.loads_json_evaluate("""{
                             "prefix": "A",
@@ -1020,6 +1780,57 @@ class TestEXJSONSerialization(TestCase):
             }
         })
 
+    def test_load_json_evaluate_chained_and_forward_references(self):
+        count = 3000
+        values = ['"v{0}": "$root.v{1}"'.format(i, i + 1) for i in range(0, count)]
+        items = ['{{"id": "$root.prefix-{0}", "base": $root.base}}'.format(i) for i in range(0, count)]
+        result = self._scenarios.loads_json_evaluate("{" + ", ".join(values) + """, "v%d": "end",
+                            "items": [%s], "base": { "name": "$root.v0" }, "prefix": "A" }""" % (count, ", ".join(items)))
+        self.assertEqual(result["v0"], "end")
+        self.assertEqual(result["items"][2999], {"id": "A-2999", "base": {"name": "end"}})
+
+    def test_load_json_evaluate_circular_references_raises_an_error(self):
+        with self.assertRaises(exjson.ReferenceRecursionError) as context:
+            self._scenarios.loads_json_evaluate("""{ "a": "$root.b", "b": "$root.c", "c": "x-$root.a", "d": 1 }""")
+        self.assertEqual(str(context.exception), "Reference Recursion Found in values a -> b -> c.")
+
+    def test_loads_json_evaluate_references_with_decoder_hooks(self):
+        result = exjson.loads("""{ "price": 12345678901234567890.123456789, "rate": 1.10, "a": 1, "a": 2,
+                                   "label": "$root.rate", "copy": $root.price, "item": { "x": 1.10, "y": $this.x } }""",
+                              parse_float=Decimal, object_pairs_hook=list)
+        self.assertEqual(result, [("price", Decimal("12345678901234567890.123456789")), ("rate", Decimal("1.10")),
+                                  ("a", 1), ("a", 2), ("label", "1.10"),
+                                  ("copy", Decimal("12345678901234567890.123456789")),
+                                  ("item", [("x", Decimal("1.10")), ("y", Decimal("1.10"))])])
+        self.assertEqual(str(result[5][1]), "12345678901234567890.123456789")
+
+    def test_loads_json_evaluate_lazily(self):
+        calls = []
+
+        def custom_track(*args):
+            calls.append(args[0])
+            return args[0]
+
+        registry = exjson.ExtensionRegistry()
+        registry.register("test_track", custom_track)
+        json_source = """{
+                            "first": { "name": "$.test_track('first')", "n": $.sequence('A') },
+                            "second": { "name": "$.test_track('second')", "items": [ $.sequence('A'), "$root.third" ] },
+                            "third": "$root.first.name-$this.fourth",
+                            "fourth": 4
+                            }"""
+        result = self._scenarios.loads_json_evaluate_lazily(json_source, extension_registry=registry)
+        self.assertIsInstance(result, exjson.LazyMapping)
+        self.assertEqual(calls, [])
+        self.assertEqual(result["second"]["items"][-1], "first-4")
+        self.assertEqual(calls, ["first"])
+        self.assertEqual(result["second"]["items"][0], 2)
+        self.assertEqual(result["first"]["n"], 1)
+        self.assertEqual(result, self._scenarios.loads_json_evaluate(json_source, extension_registry=registry))
+        self.assertDictEqual(result.materialize(),
+                             self._scenarios.loads_json_evaluate(json_source, extension_registry=registry))
+        self.assertEqual(calls.count("second"), 3)
+
     def test_load_json_evaluate_file_checksum(self):
         result = self._scenarios.loads_json_evaluate("""{
                             "file": "../LICENSE",
@@ -1039,3 +1850,170 @@ class TestEXJSONSerialization(TestCase):
             "file": "../LICENSE",
             "checksum": "9676540206bb2ea20122340f93d1b7b9ffabfb60"
         })
+
+    # Compiled Documents
+
+    def test_compile_json_renders_dynamic_values_only(self):
+        template = self._scenarios.compile_json("""{
+                            "static": { "values": [1, 2, 3] },
+                            "id": "$.uuid()",
+                            "parent_id": "$root.id",
+                            "first": $.sequence('A'),
+                            "second": "A-$.sequence('A')",
+                            "total": "$root.static.values"
+                            }""")
+        first = template.render()
+        second = template.render()
+        self.assertEqual(first["first"], 1)
+        self.assertEqual(first["second"], "A-2")
+        self.assertEqual(second["first"], 1)
+        self.assertEqual(second["second"], "A-2")
+        self.assertEqual(first["parent_id"], first["id"])
+        self.assertEqual(second["parent_id"], second["id"])
+        self.assertNotEqual(first["id"], second["id"])
+        self.assertEqual(first["total"], "[1, 2, 3]")
+        self.assertIsNot(first["static"], second["static"])
+
+    def test_compile_json_renders_independent_documents(self):
+        template = self._scenarios.compile_json("""{
+                            "static": { "values": [1, 2, 3], "name": "A" },
+                            "items": [{ "id": $.sequence('A') }, { "tags": ["x"] }]
+                            }""")
+        first = template.render()
+        first["static"]["values"].append(4)
+        first["static"]["name"] = "B"
+        first["items"][0]["id"] = 10
+        first["items"][1]["tags"].clear()
+        self.assertDictEqual(template.render(), {"static": {"values": [1, 2, 3], "name": "A"},
+                                                 "items": [{"id": 1}, {"tags": ["x"]}]})
+
+    def test_compile_json_renders_as_loads(self):
+        with open(get_sample_json_file_path("multi-include.json"), encoding="utf-8") as f:
+            json_source = f.read()
+        self.assertDictEqual(self._scenarios.compile_json(json_source).render(),
+                             self._scenarios.loads_json_evaluate(json_source))
+        template = exjson.compile(get_sample_json_file_path("pipeline.json"), encoding="utf-8")
+        self.assertDictEqual(template.render(), exjson.load(get_sample_json_file_path("pipeline.json"),
+                                                            encoding="utf-8"))
+
+    def test_compile_json_with_reference_recursion_raises_an_error(self):
+        with self.assertRaises(exjson.ReferenceRecursionError):
+            self._scenarios.compile_json("""{ "a": { "b": "$root.a" } }""")
+
+    # Import Time
+
+    def test_import_defers_extension_and_http_modules(self):
+        seconds, modules = measure_import("exjson", runs=1)
+        for module_name in ["asyncio", "concurrent.futures", "http.client", "urllib.parse", "dateutil.tz",
+                            "scripting.extensions.datetime", "scripting.extensions.cryptography", "uuid"]:
+            self.assertNotIn(module_name, modules)
+        self.assertEqual(exjson.loads("""{ "id": "$.uuid()", "date": "$.now()" }""")["id"].count("-"), 4)
+
+    # Streaming Load
+
+    def test_iterload_json_array_items(self):
+        expected = exjson.load(get_sample_json_file_path("pipeline.json"), encoding="utf-8")
+        for chunk_size in [1, 2, 7, 1024]:
+            self.assertListEqual(self._scenarios.iterload_json(get_sample_json_file_path("pipeline.json"),
+                                                               "Stages.item", chunk_size), expected["Stages"])
+            self.assertListEqual(self._scenarios.iterload_json(get_sample_json_file_path("pipeline.json"),
+                                                               "Name", chunk_size), [expected["Name"]])
+            self.assertListEqual(self._scenarios.iterload_json(get_sample_json_file_path("pipeline.json"),
+                                                               "", chunk_size), [expected])
+
+    def test_iterload_json_with_comments_includes_and_scripting(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            shutil.copy(get_sample_json_file_path("clean-simple.json"), temp_dir)
+            json_file_path = os.path.join(temp_dir, "items.json")
+            with open(json_file_path, "w", encoding="utf-8") as f:
+                f.write("""{ "Items": [
+                    // First item
+                    { "Url": "https://github.com/prods/exjson", "Quoted": "\\"/* not a comment */", "Id": $.sequence('A'),
+                      "Self": "$this.Url" },
+                    /* #INCLUDE <clean-simple.json> */
+                    // #INCLUDE <clean-simple.json>
+                    "Text", 1.5, null, "$.md5('a')", [1, [2, { "Count": "$parent.Count" }]], "A-$.sequence('A')",
+                    { "Item": "$.now().add(days=1,'yyyy')", "Id": $.sequence('A') } // Last item
+                ] }""")
+            expected = exjson.load(json_file_path, encoding="utf-8")["Items"]
+            for chunk_size in [1, 3, 16, 1024]:
+                self.assertListEqual(self._scenarios.iterload_json(json_file_path, "Items.item", chunk_size), expected)
+            self.assertEqual(expected[0]["Self"], "https://github.com/prods/exjson")
+            self.assertDictEqual(expected[1], exjson.load(get_sample_json_file_path("clean-simple.json")))
+            # Sequences keep counting across the streamed values
+            self.assertListEqual([expected[0]["Id"], expected[8], expected[9]["Id"]], [1, "A-2", 3])
+            self.assertEqual(len(expected), 10)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    # JSON Lines
+
+    def test_load_lines_json_with_comments_and_includes(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            shutil.copy(get_sample_json_file_path("clean-simple.json"), temp_dir)
+            with open(os.path.join(temp_dir, "included.jsonl"), "w", encoding="utf-8") as f:
+                f.write("""{ "Id": 100 } // Included record
+                /* #INCLUDE <missing.jsonl|{}> */
+                """)
+            json_file_path = os.path.join(temp_dir, "records.jsonl")
+            with open(json_file_path, "w", encoding="utf-8") as f:
+                f.write("// Records\n")
+                for i in range(0, 50):
+                    f.write('{ "Id": %d, "Url": "https://github.com/prods/exjson" } // Record %d\n' % (i, i))
+                    if i == 10:
+                        f.write("\n// #INCLUDE <included.jsonl>\n")
+                f.write('{ "Id": 50, "Self": "$this.Id", /* #INCLUDE <Included:clean-simple.json> */ }')
+            expected = [{"Id": i, "Url": "https://github.com/prods/exjson"} for i in range(0, 50)]
+            expected[11:11] = [{"Id": 100}, {}]
+            expected.append({"Id": 50, "Self": "50",
+                             "Included": exjson.load(get_sample_json_file_path("clean-simple.json"))})
+            for chunk_size in [1, 64, 1024 * 1024]:
+                self.assertListEqual(list(exjson.load_lines(json_file_path, workers=1, chunk_size=chunk_size)),
+                                     expected)
+            self.assertListEqual(list(exjson.load_lines(json_file_path, workers=2, chunk_size=256)), expected)
+            records = list(exjson.load_lines(json_file_path, workers=2, ordered=False, chunk_size=256))
+            self.assertListEqual(sorted(records, key=lambda record: json.dumps(record, sort_keys=True)),
+                                 sorted(expected, key=lambda record: json.dumps(record, sort_keys=True)))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_load_lines_json_with_recursive_include_raises_an_error(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            json_file_path = os.path.join(temp_dir, "records.jsonl")
+            with open(json_file_path, "w", encoding="utf-8") as f:
+                f.write('{ "Id": 1 }\n// #INCLUDE <records.jsonl>\n')
+            with self.assertRaises(exjson.IncludeRecursionError):
+                list(exjson.load_lines(json_file_path, workers=1))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    # Batch Load
+
+    def test_load_many_json_files_sharing_included_files(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            shutil.copy(get_sample_json_file_path("clean-simple.json"), temp_dir)
+            json_file_paths = []
+            for i in range(0, 20):
+                json_file_paths.append(os.path.join(temp_dir, "pipeline.%03d.json" % i))
+                with open(json_file_paths[-1], "w", encoding="utf-8") as f:
+                    f.write("""{ "Id": %d, // #INCLUDE <Shared:clean-simple.json>
+                    }""" % i)
+            json_file_paths.insert(5, os.path.join(temp_dir, "missing.json"))
+            include_cache = exjson.IncludeCache()
+            results = exjson.load_many(json_file_paths, workers=4, include_cache=include_cache)
+            self.assertEqual(len(results), 21)
+            self.assertIsInstance(results.pop(5), IOError)
+            shared = exjson.load(get_sample_json_file_path("clean-simple.json"))
+            self.assertListEqual(results, [{"Id": i, "Shared": shared} for i in range(0, 20)])
+            # Files loaded concurrently wait for the shared fragment to be expanded once
+            self.assertEqual(include_cache.stats()["misses"], 1)
+            self.assertEqual(include_cache.stats()["hits"], 19)
+            results = exjson.load_many(json_file_paths, workers=2, use_processes=True)
+            self.assertIsInstance(results.pop(5), IOError)
+            self.assertListEqual(results, [{"Id": i, "Shared": shared} for i in range(0, 20)])
+        finally:
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,36 @@
+import json
+import os
+import subprocess
+import sys
+
+_IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {0}
+elapsed = time.perf_counter() - start
+import json
+print(json.dumps({{"seconds": elapsed, "modules": sorted(sys.modules)}}))
+"""
+
+
+def measure_import(module_name, runs=5):
+    """Imports a module in fresh interpreters and gets the best import time in seconds and the loaded modules"""
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    if "SRC_ROOT" in os.environ:
+        root = os.path.abspath(os.environ['SRC_ROOT'])
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get("PYTHONPATH", "")]))
+    best = None
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", _IMPORT_SCRIPT.format(module_name)], cwd=root, env=env,
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output)
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return best["seconds"], set(best["modules"])
+
+
+if __name__ == "__main__":
+    # Import time benchmark: python -m tests.tools.importtime [module ...]
+    for name in sys.argv[1:] or ["json", "exjson"]:
+        seconds, modules = measure_import(name)
+        print("import {0}: {1:.1f} ms, {2} modules loaded".format(name, seconds * 1000, len(modules)))